@@ -2,7 +2,7 @@
 # Modified (August, 2009) by Anthony Theocharis,
 # from code by George Tzanetakis (January, 16, 2007)
 from marsyas import *
-from numpy import mean, array, dot, sqrt, subtract, zeros, copy
+from numpy import mean, array, dot, sqrt, subtract, zeros, copy, concatenate
 
 fstr = MarControlPtr.from_string
 fnat = MarControlPtr.from_natural
@@ -31,6 +31,25 @@ start = 0
 length = -1.0
 downSample = 1
 
+# Segment sampling. Rather than ticking through a whole (possibly very long)
+# file, analyse numSegments evenly spaced segments of segmentLength seconds
+# each, and never more than maxDuration seconds in total. Files shorter than
+# that are analysed in full. Off (0) by default, since sampled vectors differ
+# from full-file ones; eg, set numSegments = 10 to turn it on.
+numSegments = 0
+segmentLength = 3.0
+maxDuration = 30.0
+
+def vectorVariant():
+    """
+    Returns a string describing the sampling settings, so that vectors
+    cached under one setting aren't reused under another. Full-file
+    extraction has no variant.
+    """
+    if numSegments <= 0:
+        return ''
+    return "segments:%d:%r:%r" % (numSegments, segmentLength, maxDuration)
+
 def realvec_to_list(vec):
     """
     Convert a realvec object to a list object.
@@ -276,11 +295,98 @@ def bextract_train_refactored(filename="bextract_single.mf", playlist=True, weka
 
     return processedFeatures
 
+def fileInfo(filename):
+    """
+    Returns a tuple of (number of samples, sample rate) for the audio file.
+    """
+    mng = MarSystemManager()
+    src = mng.create("SoundFileSource", "src")
+    src.updControl("mrs_string/filename", fstr(filename))
+    size = src.getControl("mrs_natural/size").to_natural()
+    rate = src.getControl("mrs_real/israte").to_real()
+    return (size, rate)
+
+def sampleSegments(size, rate):
+    """
+    Returns a list of (start sample, number of samples) tuples describing the
+    segments of a file of the provided size and sample rate to analyse, or
+    None if the whole file should be analysed.
+    """
+    if numSegments <= 0 or size <= 0 or rate <= 0:
+        return None
+
+    seconds = min(segmentLength, float(maxDuration) / numSegments)
+    seg_size = int(seconds * rate) / hopSize * hopSize
+    if seg_size <= 0 or size <= seg_size * numSegments:
+        return None
+
+    # Spread the segments evenly, with equal gaps before, between and after.
+    gap = (size - seg_size * numSegments) / (numSegments + 1)
+    return [(gap + i * (gap + seg_size), seg_size) for i in range(numSegments)]
+
+def bextract_segments(filename, segments, mem_size=1):
+    """
+    Runs the bextract feature network over each segment of the file, and
+    returns the texture statistics of every analysis frame, as a list of
+    lists of floats.
+    """
+    mng = MarSystemManager()
+
+    fnet = mng.create("Series", "featureNetwork")
+    fnet.addMarSystem(mng.create("SoundFileSource", "src"))
+    fnet.addMarSystem(mng.create("Stereo2Mono", "s2m"))
+    featExtractor = mng.create("TimbreFeatures", "featExtractor")
+    selectFeatureSet(featExtractor)
+    fnet.addMarSystem(featExtractor)
+    fnet.addMarSystem(mng.create("TextureStats", "tStats"))
+    fnet.updControl("TextureStats/tStats/mrs_natural/memSize", fnat(mem_size))
+
+    fnet.updControl("mrs_natural/inSamples", fnat(hopSize))
+    fnet.updControl("TimbreFeatures/featExtractor/mrs_natural/winSize", fnat(winSize))
+    fnet.updControl("SoundFileSource/src/mrs_string/filename", fstr(filename))
+
+    ctrl_notEmpty = fnet.getControl("SoundFileSource/src/mrs_bool/notEmpty")
+
+    frames = []
+    for seg_start, seg_size in segments:
+        fnet.updControl("SoundFileSource/src/mrs_natural/pos", fnat(seg_start))
+        fnet.updControl("TextureStats/tStats/mrs_bool/reset", fbool(True))
+        for i in range(seg_size / hopSize):
+            if not ctrl_notEmpty.to_bool():
+                break
+            fnet.tick()
+            out = fnet.getControl("mrs_realvec/processedData").to_realvec()
+            # one column per frame
+            frames.extend(array(realvec_to_list(out)[0]).T.tolist())
+
+    return frames
+
+def createSegmentVector(filename, segments):
+    """
+    Merges the texture statistics of every sampled frame into a single vector
+    laid out like bextract's song statistics: the mean of each feature,
+    followed by the standard deviation of each feature.
+    """
+    frames = bextract_segments(filename, segments)
+    if not frames:
+        return []
+
+    frames = array(frames)
+    result = concatenate((frames.mean(axis=0), frames.std(axis=0)))
+    return [float(x) for x in result]
+
 def createVector(filename):
+    segments = None
+    if numSegments > 0:
+        size, rate = fileInfo(filename)
+        segments = sampleSegments(size, rate)
+
+    if segments is not None:
+        return createSegmentVector(filename, segments)
+
     vec = bextract_train_refactored(filename=filename, playlist=False)
     for key in vec: # there should be only one
         vec[key].transpose()
         vec[key] = realvec_to_list(vec[key])[0][0]
         result = vec[key]
         return [float(x) for x in array(result)]
-
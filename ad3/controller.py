@@ -1,22 +1,17 @@
 import sys
 import os
+import hashlib
+import time
 from numpy import array, concatenate, divide, mean
-from copy import copy
 from ad3.models.dht import AudioFile, Plugin, PluginOutput, Tag
 from twisted.internet import defer
 from twisted.internet import threads
-from functools import partial
 from sets import Set
 
+import extraction
+from scheduler import GenerationScheduler
 from logs import logger
 
-currently_generating = False
-generating_queue = []
-generating_df = defer.Deferred()
-generating_df.callback('start')
-go_through_scheduled = 0
-network_size = 3
-
 
 class TagAggregator(object):
     """
@@ -103,34 +98,202 @@ class FileAggregator(object):
         return list_df
 
 
-class Controller(object):
+class GuessTracker(object):
+    """
+    Remembers the file and tag vectors seen by the last guess_tags run, and
+    the (file, tag) pairs guessed on the network, so that the next run only
+    needs to re-evaluate pairs where either vector has changed since.
 
-    def __init__(self, data_model, learning_algorithm):
-        self.model = data_model
-        self.mine = learning_algorithm
+    Files the tracker hasn't seen yet have their guesses read from the
+    network before they are evaluated, since any node may have guessed
+    them.
+    """
+    def __init__(self):
+        self.file_digests = {}  # file key -> digest of file.vector
+        self.tag_digests = {}   # tag key -> digest of tag.vector
+        self.guessed = Set()    # (file key, tag key) pairs
+
+    def reset(self):
+        self.__init__()
+
+    def unknown(self, files):
+        """ Return the files whose guesses we haven't read yet. """
+        return [f for f in files if f.get_key() not in self.file_digests]
+
+    def learn(self, files, pairs):
+        """ Record pairs as every guess on the network for files. """
+        keys = Set([f.get_key() for f in files])
+        self.guessed = Set([p for p in self.guessed if p[0] not in keys])
+        self.guessed.update(pairs)
+
+    def digest(self, vector):
+        return hashlib.sha1(repr(vector)).digest()
+
+    def changed(self, objs, digests):
+        """ Split objs into lists of (changed, unchanged) objects """
+        changed = []
+        unchanged = []
+        for obj in objs:
+            if digests.get(obj.get_key()) == self.digest(obj.vector):
+                unchanged.append(obj)
+            else:
+                changed.append(obj)
+        return changed, unchanged
 
-    def initialize_storage(self, callback):
-        self.model.initialize_storage(callback)
+    def seen(self, files, tags=()):
+        """ Record the vectors of files and tags as evaluated.
+
+        Tags should only be recorded by a run that covered every file, since
+        files outside the run haven't been evaluated against their vectors.
+        """
+        for file in files:
+            self.file_digests[file.get_key()] = self.digest(file.vector)
+        for tag in tags:
+            self.tag_digests[tag.get_key()] = self.digest(tag.vector)
+
+
+class TagRefreshJob(object):
+    """
+    Recalculates and saves the vector of every tag in a list, with at most
+    `concurrency` tags in progress at once.
+
+    go() returns a deferred that fires once every tag has been saved.
+    progress() can be called at any time to see how the job is going.
+    """
+    # seconds between progress log messages
+    report_interval = 5
 
-    def update_tag_vectors(self, tag_name = None):
-        def got_vector(vector, tag):
+    def __init__(self, controller, tags, concurrency=8, full=False):
+        self.controller = controller
+        self.tags = tags
+        self.concurrency = concurrency
+        self.full = full
+
+        self.num_done = 0
+        self.num_failed = 0
+        self.started = None
+        self.finished = None
+        self._last_report = 0
+
+    def __repr__(self):
+        return "<TagRefreshJob(%r)>" % (self.progress(),)
+
+    def progress(self):
+        """ Returns a dict describing the progress of the job. Rate is in
+        tags per second, eta in seconds.
+        """
+        total = len(self.tags)
+        complete = self.num_done + self.num_failed
+        elapsed = 0.0
+        rate = None
+        eta = None
+        if self.started is not None:
+            elapsed = (self.finished or time.time()) - self.started
+        if complete and elapsed > 0:
+            rate = complete / elapsed
+            eta = (total - complete) / rate
+
+        return dict(
+            total = total,
+            done = self.num_done,
+            failed = self.num_failed,
+            elapsed = elapsed,
+            rate = rate,
+            eta = eta,
+        )
+
+    def refresh_tag(self, tag):
+        mine = self.controller.mine
+        model = self.controller.model
+
+        def got_vector(vector):
             tag.vector = vector
             logger.debug("-> Saving vector for %r", tag)
-            s_df = self.model.save(tag)
+            s_df = model.save(tag)
             return s_df
 
-        # Update the vector for every tag, based on the new output
-        def got_tags(tags):
-            dfs = []
-            for tag in tags:
-                logger.debug("-> Fetching vector for %r", tag)
-                cb = partial(got_vector, tag)
-                t_df = self.mine.calculate_tag_vector(tag)
-                t_df.addCallback(got_vector, tag)
+        logger.debug("-> Fetching vector for %r", tag)
+        if self.full and getattr(mine, 'keeps_tag_statistics', False):
+            df = mine.calculate_tag_vector(tag, full=True)
+        else:
+            df = mine.calculate_tag_vector(tag)
+        df.addCallback(got_vector)
+        return df
 
-            list_df = defer.DeferredList(dfs)
-            return list_df
+    def go(self):
+        def succeeded(val):
+            self.num_done += 1
+            report()
+            return val
+
+        def failed(failure, tag):
+            logger.warn("Could not refresh vector for %r: %s", tag, failure.getErrorMessage())
+            self.num_failed += 1
+            report()
+            return failure
+
+        def report():
+            now = time.time()
+            if now - self._last_report >= self.report_interval:
+                self._last_report = now
+                logger.info("Tag refresh: %r", self.progress())
+
+        def done(results):
+            self.finished = time.time()
+            logger.info("Tag refresh finished: %r", self.progress())
+            return results
+
+        self.started = time.time()
+        sem = defer.DeferredSemaphore(self.concurrency)
+        dfs = []
+        for tag in self.tags:
+            df = sem.run(self.refresh_tag, tag)
+            df.addCallbacks(succeeded, failed, errbackArgs=(tag,))
+            dfs.append(df)
+
+        list_df = defer.DeferredList(dfs, consumeErrors=True)
+        list_df.addCallback(done)
+        return list_df
+
+
+class Controller(object):
+    def __init__(self, data_model, learning_algorithm, executor=None,
+            generating_limit=4, queue_limit=100):
+        self.model = data_model
+        self.mine = learning_algorithm
+
+        # Runs the analysis plugins. See ad3.extraction
+        if executor is None:
+            executor = extraction.ThreadExecutor()
+        self.executor = executor
+
+        # Decides which files get their vectors generated, and when.
+        self.scheduler = GenerationScheduler(self.generate_vectors,
+                max_concurrent=generating_limit, max_queued=queue_limit)
+
+        # Lets guess_tags skip file/tag pairs that haven't changed.
+        self.guesses = GuessTracker()
+
+        # The most recent TagRefreshJob started by update_tag_vectors.
+        self.tag_refresh = None
 
+    def initialize_storage(self, callback):
+        self.model.initialize_storage(callback)
+
+    def update_tag_vectors(self, tag_name = None, full = False, concurrency = 8):
+        """ Recalculate and save the vector of every tag (or just the tag
+        named tag_name), at most `concurrency` tags at a time.
+
+        With full=True, learners that keep running tag statistics rebuild
+        them from scratch.
+
+        The job is kept as self.tag_refresh, so that its progress can be
+        checked while it runs. Immediately returns a deferred that will
+        return once every tag has been saved.
+        """
+        def got_tags(tags):
+            self.tag_refresh = TagRefreshJob(self, tags, concurrency, full)
+            return self.tag_refresh.go()
 
         df = self.model.get_tags(name=tag_name)
         df.addCallback(got_tags)
@@ -154,8 +317,14 @@ class Controller(object):
         def save_file(vector):
             logger.debug("--> Applying vector to %r %r", audio_file, vector)
             logger.debug("--> Saving %r", audio_file)
+            old_vector = audio_file.vector
             audio_file.vector = vector
             df_s = self.model.save(audio_file)
+            if old_vector is not None and old_vector != vector:
+                # Tags that count this file still count its old vector.
+                df_s.addCallback(lambda val:
+                        self.model.replace_file_vector(audio_file, old_vector))
+                df_s.addCallback(lambda val: audio_file)
             return df_s
 
         logger.debug("NB: Updating File Vectors for %r", audio_file)
@@ -166,105 +335,219 @@ class Controller(object):
         return df
 
 
-    def get_vectors_eventually(self, audio_file):
-        def got_vectors(result):
-            global go_through_scheduled
+    def get_vectors_eventually(self, audio_file, priority=0):
+        """ Queue audio_file with self.scheduler.
+
+        Immediately returns a deferred that will return once the
+        PluginOutput objects for the file have been saved.
+        """
+        logger.debug("NB: Scheduling generation for %r", audio_file)
+        df = self.scheduler.submit(audio_file, priority)
+        return df
+
+
+    def generate_vectors(self, audio_file):
+        """ Create and save PluginOutput objects for audio_file.
+
+        Vectors already calculated for the same audio content (by any node)
+        are reused. Otherwise the work is done on a remote node if one will
+        accept it, or locally.
+
+        Immediately returns a deferred that will return once the
+        PluginOutput objects have been saved.
+        """
+        scoped_plugins = []
 
+        def got_vectors(result):
             logger.debug("  NB: Model generation returned %r for %r", type(result), audio_file)
-            # Create new PluginOutput objects and store them on the network
             if result is None:
-                # if the model couldn't do its special generation, immediately,
-                # add the file to the generation queue.
-                logger.debug("    NB: Adding %r to the queue", audio_file)
-                df_p = defer.Deferred()
-                generating_queue.append((df_p, audio_file))
-                if go_through_scheduled * network_size < len(generating_queue):
-                    generating_df.addCallback(self.go_through_queue)
-                    go_through_scheduled += 1
+                # the model couldn't do its special generation, so do it here.
+                logger.debug("    NB: Generating vectors locally for %r", audio_file)
+                df_p = self.generate_plugin_outputs(audio_file)
             else:
                 logger.debug("    NB: Got the plugin outputs for %r!", audio_file)
                 df_p = self.generate_plugin_outputs_from_dict(result)
 
             return df_p
 
-        logger.debug("NB: Trying model generation for %r", audio_file)
-        df = self.model.special_generate_plugin_vectors(audio_file)
-        df.addCallback(got_vectors)
+        def got_cached(cached):
+            if cached is not None and len(cached) == len(scoped_plugins):
+                logger.debug("NB: Found cached vectors for %r", audio_file)
+                results = dict([((audio_file.get_key(), k), cached[k]) for k in cached])
+                return self.generate_plugin_outputs_from_dict(results)
+
+            logger.debug("NB: Trying model generation for %r", audio_file)
+            df = self.model.special_generate_plugin_vectors(audio_file)
+            df.addCallback(got_vectors)
+            return df
+
+        def get_cached(plugins):
+            scoped_plugins.extend(plugins)
+            df = self.get_cached_plugin_vectors(plugins, audio_file)
+            return df
+
+        df = self.model.get_plugins()
+        df.addCallback(get_cached)
+        df.addCallback(got_cached)
         return df
 
 
-    def go_through_queue(self, val):
-        global go_through_scheduled, currently_generating
-        go_through_scheduled -= 1
-
-        logger.debug("NB: Going through the queue, because %r", val)
-        inner_df = defer.Deferred()
-
-        def generated(val, df, audio_file):
-            global currently_generating
-            currently_generating = False
-            logger.debug("NB: Finished generating vectors for %r", audio_file)
-            df.callback(val)
-            return 'generated last one!'
-
-        def generated_eventually(val, df, audio_file):
-            logger.debug("NB: Finished eventually generating vectors for %r", audio_file)
-            df.callback(val)
- 
-        logger.debug("NB: testing currently_generating")
-        if generating_queue:
-            currently_generating = True
-            df, audio_file = generating_queue.pop(0)
-            logger.debug("  NB: Begin generating vectors for %r", audio_file)
-            df_p = self.generate_plugin_outputs(audio_file)
-            df_p.addCallback(generated, df, audio_file)
-            df_p.addCallback(inner_df.callback)
-        else:
-            currently_generating = False
-            inner_df.callback('Nothing to generate at this time.')
+    def get_content_digest(self, audio_file):
+        """ Immediately returns a deferred that will return the content
+        digest of audio_file, calculating it in a thread if need be.
+
+        Returns None if the file can't be read.
+        """
+        def got_digest(digest):
+            audio_file.content_digest = digest
+            return digest
 
-        logger.debug("NB: testing generating_queue")
+        def failed(failure):
+            logger.warn("Could not read %r: %s", audio_file.file_name, failure.getErrorMessage())
+            return None
 
-        # use a secondary queue. 
-        # in the event that no deferreds are scheduled, get_vectors_eventaully
-        # may call back in order, and append to generating_queue, so we create
-        # a copy, which we know won't have extra crap added to it.
-        clone_queue = copy(generating_queue)
-        i = 0
-        while clone_queue and i < network_size:
-            df, audio_file = clone_queue.pop(0)
-            generating_queue.pop(0)
+        if getattr(audio_file, 'content_digest', None):
+            return defer.succeed(audio_file.content_digest)
 
-            logger.debug("NB: testing (eventually, %d)  %r", i, audio_file)
-            df_v = self.get_vectors_eventually(audio_file)
-            df_v.addCallback(generated_eventually, df, audio_file)
+        df = threads.deferToThread(extraction.content_digest, audio_file.file_name)
+        df.addCallbacks(got_digest, failed)
+        return df
 
-            i += 1
 
-        logger.debug("NB: returning")
+    def get_cached_plugin_vectors(self, plugins, audio_file):
+        """ Look up vectors previously calculated for the contents of
+        audio_file, for each of the provided plugins.
 
-        return inner_df
+        Immediately returns a deferred that will return a dict of
+        plugin_key => vector, or None if the file's contents are unknown.
+        """
+        def got_digest(digest):
+            if digest is None:
+                return None
+            return self.model.get_plugin_vectors_by_digest(plugins, digest)
+
+        df = self.get_content_digest(audio_file)
+        df.addCallback(got_digest)
+        return df
 
 
-    def guess_tags(self, audio_file=None, user_name=None):
+    def guess_tags(self, audio_file=None, user_name=None, full=False):
+        """ Guess tags for audio_file, or every file belonging to user_name.
+
+        Only (file, tag) pairs where the file vector or the tag vector has
+        changed since the last run are re-evaluated, and only guesses that
+        were added or removed are written to the network.
+
+        Files this node hasn't evaluated before (every file, with full=True)
+        have their existing guesses read from the network first, and all of
+        their pairs are evaluated. Guesses for files outside the scope of
+        this run are left alone. Tags are only recorded as evaluated by runs
+        that cover every file, so that a run scoped to one file or user
+        doesn't hide tag changes from the rest.
+
+        The tracker only records guesses once they have been written, so
+        that anything that failed is retried on the next run.
+        """
         # We use a list to allow modification of the tags variable
         # from within the functions defined below.
         scoped_tags = [0]
+        tracker = self.guesses
 
-        def got_files(files):
+        def match(files, tags):
+            if not files or not tags:
+                return []
+            if hasattr(self.mine, 'match_matrix'):
+                return self.mine.match_matrix(files, tags)
+            return [(file, tag) for file in files for tag in tags
+                    if self.mine.does_tag_match(file, tag)]
+
+        def evaluate(val, files):
             logger.debug("guess_tags")
             tags = scoped_tags[0]
 
+            dirty_files, clean_files = tracker.changed(files, tracker.file_digests)
+            dirty_tags, clean_tags = tracker.changed(tags, tracker.tag_digests)
+            logger.debug("guess_tags: %d of %d files and %d of %d tags changed",
+                    len(dirty_files), len(files), len(dirty_tags), len(tags))
+
+            pairs = match(dirty_files, tags)
+            pairs.extend(match(clean_files, dirty_tags))
+            matches = Set([(f.get_key(), t.get_key()) for f, t in pairs])
+
+            new_guesses = []
+            for file, tag in pairs:
+                if (file.get_key(), tag.get_key()) not in tracker.guessed:
+                    logger.debug("-> GENERATED: %r %r", file, tag)
+                    new_guesses.append((file, tag))
+
+            # Files whose writes failed are evaluated again next time.
+            failed_files = Set()
+
+            def guessed(val, guesses):
+                tracker.guessed.update([(f.get_key(), t.get_key()) for f, t in guesses])
+
+            def unguessed(val, key):
+                tracker.guessed.discard(key)
+
+            def failed(failure, file_keys):
+                logger.warn("guess_tags: couldn't write guesses: %s", failure.getErrorMessage())
+                failed_files.update(file_keys)
+
             dfs = []
-            for file in files:
-                for tag in tags:
-                    if self.mine.does_tag_match(file, tag):
-                        logger.debug("-> GENERATED: %r %r", file, tag)
-                        df = self.model.guess_tag_for_file(file, tag)
-                        dfs.append(df)
+            if new_guesses:
+                df = self.model.guess_tags_for_files(new_guesses)
+                df.addCallbacks(guessed, failed, callbackArgs=(new_guesses,),
+                        errbackArgs=([f.get_key() for f, t in new_guesses],))
+                dfs.append(df)
+
+            # Previous guesses for re-evaluated pairs that no longer match.
+            evaluated = [(f, t) for f in dirty_files for t in tags]
+            evaluated.extend([(f, t) for f in clean_files for t in dirty_tags])
+            for file, tag in evaluated:
+                key = (file.get_key(), tag.get_key())
+                if key in tracker.guessed and key not in matches:
+                    logger.debug("-> UNGUESSED: %r %r", file, tag)
+                    df = self.model.remove_guessed_tag_for_file(file, tag)
+                    df.addCallbacks(unguessed, failed, callbackArgs=(key,),
+                            errbackArgs=([key[0]],))
+                    dfs.append(df)
+
+            def done(val):
+                if audio_file is None and user_name is None:
+                    seen_tags = tags
+                else:
+                    seen_tags = []
+                tracker.seen([f for f in files if f.get_key() not in failed_files], seen_tags)
+                if failed_files:
+                    # Re-evaluate every tag for them, too.
+                    for key in failed_files:
+                        tracker.file_digests.pop(key, None)
+                return val
+
             list_df = defer.DeferredList(dfs)
+            list_df.addCallback(done)
             return list_df
 
+        def got_files(files):
+            logger.debug("guess_tags")
+            if not files:
+                logger.info("guess_tags: no files for %r %r; nothing to do",
+                        audio_file, user_name)
+                return []
+
+            if full:
+                tracker.reset()
+
+            unknown = tracker.unknown(files)
+            if not unknown:
+                return evaluate(None, files)
+
+            # Find out what has been guessed for these on the network.
+            df = self.model.get_guessed_pairs(unknown)
+            df.addCallback(lambda pairs: tracker.learn(unknown, pairs))
+            df.addCallback(evaluate, files)
+            return df
+
         def got_tags(tags):
             logger.debug("guess_tags")
             scoped_tags[0] = tags
@@ -283,29 +566,63 @@ class Controller(object):
             t_df = self.model.get_tags()
             return t_df
 
-        df = self.model.remove_guessed_tags()
+        df = defer.succeed(None)
         df.addCallback(get_tags)
         df.addCallback(got_tags)
         df.addCallback(got_files)
         return df
 
     def add_files(self, file_names, user_name, tags=None):
+        """ Add every file in file_names to the system, generating vectors
+        for the new ones and applying tags to them.
+
+        The tag set is resolved (and created, if need be) once, and files
+        that already exist are found in a single pass. As soon as each new
+        file has been saved, its tag tuples are written, at most
+        self.model's write limit at a time, so that one slow extraction
+        doesn't hold up tagging the rest.
+
+        If either lookup fails, the returned deferred fails with it.
+
+        Immediately returns a deferred that will return a dict of
+        file_name => (AudioFile object, was_created) tuples.
+        """
         result_tuples = {}
+        scoped_tags = [[]]
+
+        if tags is None:
+            tags = []
+
+        # Drop duplicate names, keeping the first occurrence.
+        seen = Set()
+        names = []
+        for file_name in file_names:
+            if file_name not in seen:
+                seen.add(file_name)
+                names.append(file_name)
 
         def done(val):
             logger.debug("Calling back outer_df with %r", result_tuples)
             return result_tuples
 
-        if tags is None:
-            tags = []
+        def wait_for_room(val, file):
+            # Don't let the generation queue grow without bound; wait
+            # until the scheduler has room for this file.
+            w_df = self.scheduler.wait_for_room()
+            w_df.addCallback(lambda v: file)
+            return w_df
 
-        def got_file(file, file_name):
-            inner_df = defer.Deferred()
+        def got_tags(tag_objs):
+            scoped_tags[0] = tag_objs
+
+        def got_existing(existing):
+            dfs = []
+            for file_name in names:
+                if file_name in existing:
+                    # file already exists
+                    result_tuples[file_name] = (existing[file_name], False)
+                    continue
 
-            if file is not None:
-                # file already exists
-                result_tuples[file_name] = (file, False)
-            else:
                 # make a new file!
                 file = AudioFile(file_name, user_name=user_name)
                 result_tuples[file_name] = (file, True)
@@ -314,55 +631,61 @@ class Controller(object):
 
                 # Take care of saving the file object, as well as creating
                 # the file.vector and PluginOutput objects, all at once!
-                inner_df.addCallback(self.update_file_vectors)
-
-                # After the file has been saved, apply the tags to it!
-                # TODO: we shouldn't get_tags for each file individually. Do it once, before saving any files.
-                if tags:
-                    def got_tags(tags):
-                        # Make sure that each apply_tag_to_file call does not overlap
-                        # FIXME: Not sure if we need this now that the network
-                        #        is tolerant of packet loss.
-                        def apply(value, file, tag):
-                            logger.debug("Attempting to apply: %r to %r ", tag, file)
-                            tag_df = self.model.apply_tag_to_file(file, tag)
-                            return tag_df
-
-                        df = defer.Deferred()
-                        for t in tags:
-                            df.addCallback(apply, file, t)
-                        df.callback(None)
-                        return df
-
-                    def get_tags(val):
-                        ta = TagAggregator(self, self.model, tags, True)
-                        ta_df = ta.go()
-                        return ta_df
-
-                    inner_df.addCallback(get_tags)
-                    inner_df.addCallback(got_tags)
-
-                # Pass "file" to our first callback
-                inner_df.callback(file)
-
-                # inner_df will 'callback', as far as the calling function is
-                # concerned, either after the file is saved, or after all tags
-                # have been applied, depending on the presence of a tags list
-                return inner_df
+                df = defer.Deferred()
+                df.addCallback(wait_for_room, file)
+                df.addCallback(self.update_file_vectors)
+                df.addCallback(apply_tags, file)
+                df.callback(None)
+                dfs.append(df)
 
-        dfs = []
-        for file_name in file_names:
-            logger.debug("Getting audio file...")
-            df = self.model.get_audio_file(file_name=file_name, user_name=user_name)
-            df.addCallback(got_file, file_name)
-            dfs.append(df)
+            list_df = defer.DeferredList(dfs)
+            return list_df
 
-        # All got_file calls will return a deferred. Because of this,
-        # list_df.callback() isn't called until all got_file calls are
-        # finished with their business.
-        list_df = defer.DeferredList(dfs)
-        list_df.addCallback(done)
-        return list_df
+        def apply_tags(val, file):
+            # Once the file has been saved, apply the tags to it!
+            if not scoped_tags[0]:
+                return None
+            logger.debug("Applying %r to %r", scoped_tags[0], file)
+            df = self.model.apply_tags_to_files([file], scoped_tags[0],
+                    check_existing=False)
+            return df
+
+        # Look up the tags and the existing files at the same time.
+        dfs = [self.find_existing_files(names, user_name)]
+        if tags:
+            ta = TagAggregator(self, self.model, tags, True)
+            t_df = ta.go()
+            t_df.addCallback(got_tags)
+            dfs.append(t_df)
+
+        def got_lookups(results):
+            return results[0][1]
+
+        def lookup_failed(failure):
+            # Hand on the lookup's own failure, not the FirstError.
+            failure.trap(defer.FirstError)
+            return failure.value.subFailure
+
+        df = defer.DeferredList(dfs, fireOnOneErrback=True, consumeErrors=True)
+        df.addCallbacks(got_lookups, lookup_failed)
+        df.addCallback(got_existing)
+        df.addCallback(done)
+        return df
+
+
+    def find_existing_files(self, file_names, user_name):
+        """ Find the AudioFile objects that already exist for file_names,
+        fetching them all by key at once.
+
+        Immediately returns a deferred that will return a dict of
+        file_name => AudioFile object.
+        """
+        def got_files(files):
+            return dict([(file.file_name, file) for file in files])
+
+        df = self.model.get_audio_files_by_name(file_names, user_name)
+        df.addCallback(got_files)
+        return df
 
 
     def add_file(self, file_name, user_name=None, tags=None):
@@ -375,17 +698,10 @@ class Controller(object):
 
 
     def tag_files(self, file_list, tag_names=[]):
-        def apply_tag(val, file, tag):
-            a_df = self.model.apply_tag_to_file(file, tag)
-            return a_df
-
         def got_tags(tags):
-            inner_df = defer.Deferred()
-            for t in tags:
-                for file in file_list:
-                    inner_df.addCallback(apply_tag, file, t)
-            inner_df.callback(None)
-            return inner_df
+            pairs = [(file, t) for t in tags for file in file_list]
+            a_df = self.model.apply_tags(pairs)
+            return a_df
 
         def get_tags(val):
             ta = TagAggregator(self, self.model, tag_names, True)
@@ -429,38 +745,63 @@ class Controller(object):
         """ Blocking function. Generates a dict of vectors for each
         file_key/plugin pair.
         """
-        outer_df = defer.Deferred()
-        results = {}
-
-        for plugin in plugins:
-            vec = plugin.create_vector(file_name)
-            key = (file_key, plugin.get_key())
-            logger.debug("Got plugin vector of length %d", len(vec))
-            results[key] = vec
-
-        return results
+        return extraction.blocking_generate_vectors(plugins, file_name, file_key)
 
 
     def generate_plugin_vectors(self, plugins, file_name, file_key):
-        """ Generate the vectors for each provided plugin in a thread.
+        """ Generate the vectors for each provided plugin using self.executor.
 
         Immediately returns a deferred which will return a dict of vectors
         """
         logger.info('Generating plugin vectors for %r and %r', file_name, plugins)
-        df = threads.deferToThread(
-                self.blocking_generate_vectors,
-                plugins, file_name, file_key
-             )
+        df = self.executor.generate_vectors(plugins, file_name, file_key)
         return df
 
 
-    def generate_all_plugin_vectors(self, file_name, file_key):
+    def generate_all_plugin_vectors(self, file_name, file_key, content_digest=None):
         """ Generate the the vectors for every plugin.
 
+        Vectors already stored for the same audio content are reused, and
+        only the missing plugins are run. Newly generated vectors are stored
+        under the content digest for the benefit of every other node.
+
         Immediately returns a deferred which will return a dict of vectors.
         """
+        audio_file = AudioFile(file_name, key=file_key, content_digest=content_digest)
+        results = {}
+        scoped_plugins = []
+
+        def got_generated(generated):
+            results.update(generated)
+            if audio_file.content_digest is not None:
+                vectors = dict([(k[1], generated[k]) for k in generated])
+                self.model.store_plugin_vectors_by_digest(
+                        audio_file.content_digest, vectors, scoped_plugins)
+            return results
+
+        def got_cached(cached):
+            if cached is None:
+                cached = {}
+            for plugin_key in cached:
+                results[(file_key, plugin_key)] = cached[plugin_key]
+
+            missing = [p for p in scoped_plugins if p.get_key() not in cached]
+            if not missing:
+                logger.debug("Every vector for %r was cached", file_name)
+                return results
+
+            df = self.generate_plugin_vectors(missing, file_name, file_key)
+            df.addCallback(got_generated)
+            return df
+
+        def get_cached(plugins):
+            scoped_plugins.extend(plugins)
+            df = self.get_cached_plugin_vectors(plugins, audio_file)
+            return df
+
         df = self.model.get_plugins()
-        df.addCallback(self.generate_plugin_vectors, file_name, file_key)
+        df.addCallback(get_cached)
+        df.addCallback(got_cached)
         return df
 
     def generate_plugin_outputs_from_dict(self, results, outputs=None):
@@ -476,19 +817,16 @@ class Controller(object):
         if outputs is None:
             outputs = []
 
-        dfs = []
+        created = []
         for key in results:
             vector = results[key]
             file_key, plugin_key = key
             logger.debug("Created plugin output of length %d", len(vector))
-            po = PluginOutput(vector, plugin_key, file_key)
-            df = self.model.save(po)
+            created.append(PluginOutput(vector, plugin_key, file_key))
 
-            outputs.append(po)
-            dfs.append(df)
-
-        list_df = defer.DeferredList(dfs)
-        return list_df
+        outputs.extend(created)
+        df = self.model.save_plugin_outputs(created)
+        return df
 
     def generate_plugin_outputs(self, audio_file):
         """ Generates and saves a PluginOutput object for the provided file
@@ -497,18 +835,14 @@ class Controller(object):
         Immediately returns a deferred that will return a list of generated
         PluginOutput objects.
         """
-        outer_df = defer.Deferred()
         outputs = []
 
-        def done(v):
-            outer_df.callback(outputs)
-
-        df = self.generate_all_plugin_vectors(
-                audio_file.file_name, audio_file.get_key())
+        df = self.generate_all_plugin_vectors(audio_file.file_name,
+                audio_file.get_key(), getattr(audio_file, 'content_digest', None))
         df.addCallback(self.generate_plugin_outputs_from_dict, outputs)
-        df.addCallback(done)
+        df.addCallback(lambda val: outputs)
 
-        return outer_df
+        return df
 
     def generate_plugin_output(self, plugin, audio_file):
         """ Generates and saves a PluginOutput object for the file/plugin
@@ -517,14 +851,14 @@ class Controller(object):
         Immediately returns a deferred that will return the result of
         saving the PluginOutput object.
         """
-        def save_plugin_output(vector):
+        def save_plugin_output(results):
+            vector = results[(audio_file.get_key(), plugin.get_key())]
             po = PluginOutput(vector, plugin.get_key(), audio_file.get_key())
             s_df = self.model.save(po)
             return s_df
 
-        # Make blocking function "plugin.create_vector" nonblocking
-        # by deferring it to its own thread!
-        df = threads.deferToThread(plugin.create_vector, audio_file.file_name)
+        df = self.generate_plugin_vectors(
+                [plugin], audio_file.file_name, audio_file.get_key())
         df.addCallback(save_plugin_output)
         return df
 
@@ -0,0 +1,264 @@
+"""
+Executors responsible for running the analysis plugins over audio files.
+
+The Controller hands every extraction job to an executor, which returns a
+deferred that will be called back, in the reactor thread, with a dict of
+vectors keyed on (file_key, plugin_key) tuples.
+
+    ThreadExecutor      - runs jobs in the reactor's thread pool. Only one
+                          core's worth of Marsyas work can happen at a time.
+    ProcessPoolExecutor - runs jobs in a bounded pool of worker processes.
+"""
+import hashlib
+import multiprocessing
+import signal
+import traceback
+from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.internet import threads
+
+from logs import logger
+
+
+# Seconds a file's extraction may take before it is given up on.
+DEFAULT_TIMEOUT = 300
+
+
+class ExtractionError(Exception):
+    """ Raised when a plugin fails inside a worker process. """
+    pass
+
+class ExtractionTimeout(Exception):
+    """ Raised when a job does not finish within the executor's timeout. """
+    pass
+
+
+def blocking_generate_vectors(plugins, file_name, file_key):
+    """ Blocking function. Generates a dict of vectors for each
+    file_key/plugin pair.
+    """
+    results = {}
+
+    for plugin in plugins:
+        vec = plugin.create_vector(file_name)
+        key = (file_key, plugin.get_key())
+        logger.debug("Got plugin vector of length %d", len(vec))
+        results[key] = vec
+
+    return results
+
+
+def content_digest(file_name, chunk_size=1024*1024):
+    """ Blocking function. Returns the hex sha1 digest of the contents of
+    file_name, so that identical audio can be recognised whatever its name.
+    """
+    h = hashlib.sha1()
+    f = open(file_name, 'rb')
+    try:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    finally:
+        f.close()
+    return h.hexdigest()
+
+
+def import_module(module_name):
+    """ Import a (possibly dotted) module name, and return the module
+    itself rather than the top level package.
+    """
+    mod = __import__(module_name)
+    for comp in module_name.split('.')[1:]:
+        mod = getattr(mod, comp)
+    return mod
+
+
+# Plugin modules imported by the current worker process, keyed on module name.
+_worker_modules = {}
+
+def _import_module(module_name):
+    if module_name not in _worker_modules:
+        _worker_modules[module_name] = import_module(module_name)
+    return _worker_modules[module_name]
+
+def _init_worker(module_names):
+    """ Runs once in each new worker process. """
+    # Workers forked while the reactor runs inherit its Python-level signal
+    # handlers, which a worker blocked on the task queue never gets to run,
+    # so Pool.terminate() would wait on it forever.
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.set_wakeup_fd(-1)
+
+    for module_name in module_names:
+        _import_module(module_name)
+
+def _worker_generate_vectors(plugin_specs, file_name, file_key):
+    """ Runs inside a worker process.
+
+    plugin_specs is a list of (module_name, plugin_key) tuples; Plugin
+    objects themselves are not sent across the process boundary.
+
+    Pool.apply_async has no way to report exceptions back to us, so
+    return a (success, value) tuple instead of raising.
+    """
+    try:
+        results = {}
+        for module_name, plugin_key in plugin_specs:
+            vec = _import_module(module_name).createVector(file_name)
+            results[(file_key, plugin_key)] = vec
+        return (True, results)
+    except Exception:
+        return (False, traceback.format_exc())
+
+
+class ThreadExecutor(object):
+    """
+    Runs extraction jobs in the reactor's thread pool, one after another.
+    """
+    def generate_vectors(self, plugins, file_name, file_key):
+        df = threads.deferToThread(
+                blocking_generate_vectors,
+                plugins, file_name, file_key
+             )
+        return df
+
+    def shutdown(self):
+        pass
+
+
+class ProcessPoolExecutor(object):
+    """
+    Runs extraction jobs in a pool of worker processes.
+
+    Attributes:
+        module_names            plugin modules every worker imports on startup
+        workers                 number of worker processes (default: one per core)
+        max_tasks_per_worker    recycle a worker after this many files (None: never)
+        timeout                 seconds a single file may take (default:
+                                DEFAULT_TIMEOUT; 0: no limit)
+
+    At most C{workers} jobs are handed to the pool at once; the rest wait
+    in the reactor, so that C{timeout} is measured from the moment a worker
+    picks up the file rather than from the moment it was queued.
+
+    A pool can't kill a single job, so when one times out the whole pool is
+    terminated and started again, and the other jobs it was running are
+    handed to the new pool from scratch. The timeout also catches workers
+    that crash: the pool replaces the process, but never reports back on
+    the job it was running.
+    """
+    def __init__(self, module_names=None, workers=None,
+            max_tasks_per_worker=None, timeout=None):
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        if timeout is None:
+            timeout = DEFAULT_TIMEOUT
+
+        self.module_names = module_names or []
+        self.workers = workers
+        self.max_tasks_per_worker = max_tasks_per_worker
+        self.timeout = timeout
+
+        self.in_flight = 0
+        self.restarts = 0
+        self._pool = None
+        self._jobs = []         # jobs handed to the current pool
+        self._generation = 0    # bumped every time the pool is replaced
+        self._shutdown_trigger = None
+        self._sem = defer.DeferredSemaphore(workers)
+
+    def start(self):
+        if self._pool is None:
+            logger.info("Starting %d extraction workers", self.workers)
+            self._pool = multiprocessing.Pool(self.workers, _init_worker,
+                    (self.module_names,), self.max_tasks_per_worker)
+            if self._shutdown_trigger is None:
+                self._shutdown_trigger = reactor.addSystemEventTrigger(
+                        'before', 'shutdown', self.shutdown)
+
+    def shutdown(self):
+        if self._pool is not None:
+            logger.info("Stopping extraction workers")
+            self._pool.terminate()
+            self._pool = None
+
+    def _restart(self):
+        """ Replace the pool, and hand it every job the old one was still
+        running.
+        """
+        logger.warn("Restarting the extraction workers")
+        self.restarts += 1
+        self._generation += 1
+        self.shutdown()
+        self.start()
+
+        jobs, self._jobs = self._jobs, []
+        for job in jobs:
+            if job['timer'] is not None and job['timer'].active():
+                job['timer'].cancel()
+            self._submit(job)
+
+    def _submit(self, job):
+        generation = self._generation
+
+        def got_result(result):
+            # Runs in the pool's result handler thread.
+            reactor.callFromThread(self._finished, job, generation, result)
+
+        job['timer'] = None
+        if self.timeout:
+            job['timer'] = reactor.callLater(self.timeout, self._timed_out, job)
+        self._jobs.append(job)
+        self._pool.apply_async(_worker_generate_vectors,
+                (job['plugin_specs'], job['file_name'], job['file_key']),
+                callback=got_result)
+
+    def _done(self, job):
+        if job['timer'] is not None and job['timer'].active():
+            job['timer'].cancel()
+        if job in self._jobs:
+            self._jobs.remove(job)
+        self.in_flight -= 1
+
+    def _finished(self, job, generation, result):
+        # Runs in the reactor thread.
+        if job['df'].called or generation != self._generation:
+            # We already gave up on this run of the file.
+            logger.debug("Discarding late vectors for %r", job['file_name'])
+            return
+        self._done(job)
+        success, value = result
+        if success:
+            job['df'].callback(value)
+        else:
+            job['df'].errback(ExtractionError(value))
+
+    def _timed_out(self, job):
+        logger.warn("Extraction of %r timed out after %d seconds",
+                job['file_name'], self.timeout)
+        self._done(job)
+        # The worker is still stuck on it, or dead.
+        self._restart()
+        job['df'].errback(ExtractionTimeout(job['file_name']))
+
+    def _run(self, plugin_specs, file_name, file_key):
+        self.start()
+        job = {
+            'plugin_specs': plugin_specs,
+            'file_name': file_name,
+            'file_key': file_key,
+            'df': defer.Deferred(),
+            'timer': None,
+        }
+        self.in_flight += 1
+        self._submit(job)
+        return job['df']
+
+    def generate_vectors(self, plugins, file_name, file_key):
+        plugin_specs = [(p.module_name, p.get_key()) for p in plugins]
+        df = self._sem.run(self._run, plugin_specs, file_name, file_key)
+        return df
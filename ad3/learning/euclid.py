@@ -1,4 +1,4 @@
-from numpy import mean, array, dot, sqrt, subtract, zeros, copy
+from numpy import mean, array, dot, sqrt, subtract, zeros, copy, nonzero
 from twisted.internet import defer
 from .. import logs
 logger = logs.logger
@@ -12,17 +12,50 @@ def euclidean_distance(a, b):
     sum_of_squares = dot(c,c)
     return sqrt(sum_of_squares)
 
+def has_vector(obj):
+    """ True if obj has a non-empty vector; works for lists and numpy arrays. """
+    return obj.vector is not None and len(obj.vector) > 0
+
 class Euclidean(object):
-    def __init__(self, data_model, tolerable_distance = 15):
+    # calculate_tag_vector takes full=True to rebuild running tag statistics
+    keeps_tag_statistics = True
+
+    def __init__(self, data_model, tolerable_distance = 15, max_block_bytes = 32 * 1024 * 1024):
         self.model = data_model
         self.tolerance = tolerable_distance
+        # largest distance matrix block match_matrix will hold in memory
+        self.max_block_bytes = max_block_bytes
 
 
-    def calculate_tag_vector(self, tag):
+    def calculate_tag_vector(self, tag, full = False):
+        """
+        Returns a deferred that will return the mean vector of all files
+        tagged with tag.
+
+        Uses the tag's running count and vector sum when they are known.
+        Otherwise, or when full is True, fetches every tagged file, and
+        rebuilds the tag's running statistics from them.
+        """
         def got_files(files):
-            vector = mean([f.vector for f in files], axis=0).tolist()
+            # Files _update_tag_stats would leave out aren't counted here either.
+            vectors = [f.vector for f in files if has_vector(f)]
+            if vectors:
+                vectors = [v for v in vectors if len(v) == len(vectors[0])]
+            if not vectors:
+                tag.count, tag.vector_sum = 0, None
+                return []
+            vector = mean(vectors, axis=0).tolist()
+            tag.count = len(vectors)
+            tag.vector_sum = array(vectors).sum(axis=0).tolist()
             return vector
 
+        if not full and getattr(tag, 'count', None) is not None:
+            if tag.count and tag.vector_sum:
+                vector = (array(tag.vector_sum) / tag.count).tolist()
+            else:
+                vector = []
+            return defer.succeed(vector)
+
         df = self.model.get_audio_files(tag = tag)
         df.addCallback(got_files)
         return df
@@ -49,3 +82,57 @@ class Euclidean(object):
             return True
         return False
 
+
+    def match_matrix(self, files, tags):
+        """
+        Batch version of does_tag_match.
+        Returns a list of (file, tag) pairs for every file within
+        self.tolerance of a tag.
+
+        File and tag vectors are stacked into matrices, and squared distances
+        are computed a block of files at a time as
+            |f|^2 - 2 f.t + |t|^2
+        with no block larger than self.max_block_bytes.
+        """
+        tags = [t for t in tags if has_vector(t)]
+        if not tags:
+            return []
+
+        # Vectors of a different length can't be compared.
+        dimensions = len(tags[0].vector)
+        skipped_tags = [t for t in tags if len(t.vector) != dimensions]
+        skipped_files = [f for f in files
+                if has_vector(f) and len(f.vector) != dimensions]
+        if skipped_tags or skipped_files:
+            logger.warn("match_matrix: skipping %d tags and %d files whose vectors "
+                    "aren't %d long: %r %r", len(skipped_tags), len(skipped_files),
+                    dimensions, skipped_tags, skipped_files)
+
+        tags = [t for t in tags if len(t.vector) == dimensions]
+        files = [f for f in files if has_vector(f) and len(f.vector) == dimensions]
+        if not files:
+            return []
+
+        file_matrix = array([f.vector for f in files], dtype=float)
+        tag_matrix = array([t.vector for t in tags], dtype=float)
+        file_norms = (file_matrix * file_matrix).sum(axis=1)
+        tag_norms = (tag_matrix * tag_matrix).sum(axis=1)
+        tolerance = self.tolerance ** 2
+
+        # Each row of a block holds one float64 distance per tag.
+        block_rows = max(1, self.max_block_bytes / (8 * len(tags)))
+
+        pairs = []
+        for start in range(0, len(files), block_rows):
+            block = file_matrix[start:start + block_rows]
+            distances = dot(block, tag_matrix.T)
+            distances *= -2
+            distances += file_norms[start:start + block_rows, None]
+            distances += tag_norms[None, :]
+
+            rows, cols = nonzero(distances <= tolerance)
+            for i, j in zip(rows, cols):
+                pairs.append((files[start + i], tags[j]))
+
+        logger.debug("MATCHED %d of %d pairs", len(pairs), len(files) * len(tags))
+        return pairs
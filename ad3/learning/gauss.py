@@ -134,6 +134,8 @@ class Gaussian(object):
 
 
     def calculate_tag_vector(self, tag):
+        # Classifiers can't be updated incrementally, so this is always
+        # a full recalculation.
         def got_files(files):
             vectors = [f.vector[0] for f in files]
             vec1 = train(vectors)
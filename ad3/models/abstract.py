@@ -37,6 +37,18 @@ class Plugin(object):
     def create_vector(self, file_name):
         return self.module.createVector(file_name)
 
+    def vector_variant(self):
+        """ Returns a string describing the module's settings that change
+        the vectors it creates, or '' if it has none.
+
+        Modules with such settings define vectorVariant(). Vectors are only
+        reused between runs with the same variant.
+        """
+        variant = getattr(self.module, 'vectorVariant', None)
+        if variant is None:
+            return ''
+        return variant()
+
 
 class AudioFile(object):
     """
@@ -1,6 +1,8 @@
 from dht import *
 from node import *
 from protocol import *
+from cache import *
+from index import *
 
 __all__ = [
     # dht.* functions
@@ -14,12 +16,23 @@ __all__ = [
     'get_plugin',
     'get_audio_files',
     'get_audio_file',
+    'get_audio_files_by_name',
     'save',
+    'save_plugin_outputs',
     'update_vector',
+    'get_plugin_vectors_by_digest',
+    'store_plugin_vectors_by_digest',
     'initialize_storage',
     'apply_tag_to_file',
+    'apply_tags',
+    'apply_tags_to_files',
+    'remove_tag_from_file',
+    'replace_file_vector',
     'remove_guessed_tags',
+    'get_guessed_pairs',
     'guess_tag_for_file',
+    'guess_tags_for_files',
+    'remove_guessed_tag_for_file',
 
     # dht.* classes
     'KeyAggregator',
@@ -31,6 +44,12 @@ __all__ = [
     'Tag',
     'PluginOutput',
 
+    # cache.* classes
+    'ObjectCache',
+
+    # index.* classes
+    'TupleIndex',
+
     # node.* classes
     'Node',
 
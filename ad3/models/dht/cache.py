@@ -0,0 +1,247 @@
+"""
+Bounded caches.
+
+ObjectCache holds decoded model objects, used by NetworkHandler so that
+repeated reads of the same key don't go back to the DHT. Entries are
+evicted least recently used first once either the entry or the byte budget
+is exceeded, and expire after a time to live that depends on the type of
+object: plugins practically never change, tags change whenever a file is
+tagged.
+
+ValueCache holds the raw values a Node has fetched or written, under a
+byte budget.
+"""
+import cPickle
+from time import time
+from collections import OrderedDict
+
+import logging
+logger = logging.getLogger('3ad')
+
+
+# Bytes we charge for every entry, on top of its vectors.
+ENTRY_OVERHEAD = 256
+
+def object_size(obj):
+    """ Rough number of bytes obj is holding on to. """
+    size = ENTRY_OVERHEAD
+    for name in ('vector', 'vector_sum'):
+        vec = getattr(obj, name, None)
+        if vec is not None:
+            try:
+                size += 8 * len(vec)
+            except TypeError:
+                pass
+    return size
+
+
+class ObjectCache(object):
+    """
+    Attributes:
+        max_entries     number of objects to keep (None: unlimited)
+        max_bytes       approximate bytes to keep (None: unlimited)
+        ttls            dict of class => seconds an object of that class
+                        stays fresh; None means it never expires
+        default_ttl     seconds for classes not in ttls
+
+        hits, misses, expirations, evictions
+    """
+    def __init__(self, max_entries=10000, max_bytes=64*1024*1024,
+            ttls=None, default_ttl=300):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttls = ttls or {}
+        self.default_ttl = default_ttl
+
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+
+        # key -> (expiry, size, obj), least recently used first
+        self._entries = OrderedDict()
+
+    def __repr__(self):
+        return "<ObjectCache(entries=%d, bytes=%d)>" % (len(self), self.bytes)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def ttl_for(self, obj):
+        for cls in type(obj).__mro__:
+            if cls in self.ttls:
+                return self.ttls[cls]
+        return self.default_ttl
+
+    def get(self, key):
+        """ Return the object cached at key, or None if there isn't a
+        fresh one.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expiry, size, obj = entry
+        if expiry is not None and time() >= expiry:
+            self.bytes -= size
+            self.expirations += 1
+            self.misses += 1
+            return None
+
+        # most recently used goes to the back
+        self._entries[key] = entry
+        self.hits += 1
+        return obj
+
+    def put(self, key, obj):
+        self.invalidate(key)
+
+        ttl = self.ttl_for(obj)
+        if ttl is not None:
+            expiry = time() + ttl
+        else:
+            expiry = None
+
+        size = object_size(obj)
+        self._entries[key] = (expiry, size, obj)
+        self.bytes += size
+        self._evict()
+
+    def invalidate(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+
+    def clear(self):
+        self._entries.clear()
+        self.bytes = 0
+
+    def items(self):
+        """ Return a list of (key, obj) for every cached object, including
+        ones that have expired but not yet been dropped.
+        """
+        return [(key, entry[2]) for key, entry in self._entries.iteritems()]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        if lookups:
+            hit_rate = float(self.hits) / lookups
+        else:
+            hit_rate = 0.0
+
+        return dict(
+            entries = len(self),
+            bytes = self.bytes,
+            max_entries = self.max_entries,
+            max_bytes = self.max_bytes,
+            hits = self.hits,
+            misses = self.misses,
+            hit_rate = hit_rate,
+            expirations = self.expirations,
+            evictions = self.evictions,
+        )
+
+    def _over_budget(self):
+        if self.max_entries is not None and len(self._entries) > self.max_entries:
+            return True
+        if self.max_bytes is not None and self.bytes > self.max_bytes:
+            return True
+        return False
+
+    def _evict(self):
+        while self._entries and self._over_budget():
+            key, entry = self._entries.popitem(last=False)
+            self.bytes -= entry[1]
+            self.evictions += 1
+            logger.debug("Evicted %s from the object cache", key.encode('hex'))
+
+
+def value_size(value):
+    """ Number of bytes a raw DHT value takes up. """
+    if isinstance(value, basestring):
+        return len(value)
+    return len(cPickle.dumps(value))
+
+
+class ValueCache(object):
+    """
+    A dict-like cache of raw DHT values which keeps their total size under
+    max_bytes, evicting least recently used values first. A value bigger
+    than max_bytes is not cached at all, so a key set a moment ago may
+    already be missing; callers should size values with value_size.
+
+    Attributes:
+        max_bytes       bytes to keep (None: unlimited)
+        bytes           bytes currently held
+        evictions       number of values evicted so far
+    """
+    def __init__(self, max_bytes=32*1024*1024):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.evictions = 0
+
+        # key -> (size, value), least recently used first
+        self._entries = OrderedDict()
+
+    def __repr__(self):
+        return "<ValueCache(entries=%d, bytes=%d)>" % (len(self), self.bytes)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __getitem__(self, key):
+        entry = self._entries.pop(key)
+        self._entries[key] = entry
+        return entry[1]
+
+    def __setitem__(self, key, value):
+        self.pop(key)
+        size = value_size(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            # It would only push everything else out, then itself.
+            self.evictions += 1
+            return
+        self._entries[key] = (size, value)
+        self.bytes += size
+        self._evict()
+
+    def __delitem__(self, key):
+        size, value = self._entries.pop(key)
+        self.bytes -= size
+
+    def keys(self):
+        return self._entries.keys()
+
+    def get(self, key, default=None):
+        if key in self._entries:
+            return self[key]
+        return default
+
+    def pop(self, key, default=None):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return default
+        self.bytes -= entry[0]
+        return entry[1]
+
+    def clear(self):
+        self._entries.clear()
+        self.bytes = 0
+
+    def _evict(self):
+        while self._entries and self.max_bytes is not None \
+                and self.bytes > self.max_bytes:
+            key, entry = self._entries.popitem(last=False)
+            self.bytes -= entry[0]
+            self.evictions += 1
@@ -0,0 +1,221 @@
+"""
+Binary encoding of the records we store in the DHT.
+
+A record is a dict with a 'type' and the fields listed for that type in
+SCHEMAS. On the wire it looks like
+
+    version (1 byte) | type (1 byte) | fields...
+
+where, in the order given by the schema,
+
+    key     the raw 20 byte key
+    str     length (4 bytes, 0xffffffff for None) | utf-8 bytes
+    int     signed 4 bytes, -1 for None
+    vector  dtype (1 byte: 0 for None, 'f' or 'd') | length (4 bytes) |
+            little endian float32 or float64 values, as numpy.frombuffer
+            reads them
+            or, for anything that isn't a flat list of numbers (the Gaussian
+            learner stores [vector, classifier] pairs),
+            'j' | length (4 bytes) | JSON
+
+Rows written before this format existed are JSON documents, which always
+start with '{'; decode() still reads those.
+"""
+import struct
+import simplejson
+from numpy import asarray, frombuffer, ndarray
+
+FORMAT_VERSION = 1
+
+# Precision vectors are written with: 'd' for float64, 'f' for float32.
+vector_precision = 'd'
+
+KEY_LENGTH = 20
+NONE_LENGTH = 0xffffffff
+
+SCHEMAS = {
+    'plugin': (1, [
+        ('key', 'key'),
+        ('name', 'str'),
+        ('module_name', 'str'),
+    ]),
+    'plugin_output': (2, [
+        ('key', 'key'),
+        ('plugin_key', 'key'),
+        ('audio_key', 'key'),
+        ('vector', 'vector'),
+    ]),
+    'tag': (3, [
+        ('key', 'key'),
+        ('name', 'str'),
+        ('count', 'int'),
+        ('vector', 'vector'),
+        ('vector_sum', 'vector'),
+    ]),
+    'audio_file': (4, [
+        ('key', 'key'),
+        ('file_name', 'str'),
+        ('user_name', 'str'),
+        ('content_digest', 'str'),
+        ('vector', 'vector'),
+    ]),
+    'plugin_vector': (5, [
+        ('plugin_key', 'key'),
+        ('content_digest', 'str'),
+        ('vector', 'vector'),
+    ]),
+}
+
+_TYPE_NAMES = dict([(code, name) for name, (code, fields) in SCHEMAS.items()])
+
+# Fields the old JSON rows stored hex encoded.
+_HEX_FIELDS = ('key', 'plugin_key', 'audio_key')
+
+_DTYPES = {'f': '<f4', 'd': '<f8'}
+JSON_VECTOR = 'j'
+
+
+class DecodeError(Exception):
+    """ Raised when a row can't be decoded. """
+    pass
+
+
+def encode(record, precision=None):
+    """ Return the binary form of record, a dict with a 'type' key. """
+    if precision is None:
+        precision = vector_precision
+
+    type_code, fields = SCHEMAS[record['type']]
+    parts = [struct.pack('!BB', FORMAT_VERSION, type_code)]
+
+    for name, kind in fields:
+        value = record.get(name)
+
+        if kind == 'key':
+            if value is None or len(value) != KEY_LENGTH:
+                raise ValueError("%s must be a %d byte key, not %r" % (name, KEY_LENGTH, value))
+            parts.append(value)
+
+        elif kind == 'str':
+            if value is None:
+                parts.append(struct.pack('!I', NONE_LENGTH))
+            else:
+                if isinstance(value, unicode):
+                    value = value.encode('utf-8')
+                parts.append(struct.pack('!I', len(value)))
+                parts.append(value)
+
+        elif kind == 'int':
+            if value is None:
+                value = -1
+            parts.append(struct.pack('!i', value))
+
+        elif kind == 'vector':
+            if value is None:
+                parts.append(struct.pack('!BI', 0, 0))
+            else:
+                array = _flat_array(value, precision)
+                if array is not None:
+                    parts.append(struct.pack('!cI', precision, len(array)))
+                    parts.append(array.tostring())
+                else:
+                    data = simplejson.dumps(value, default=_json_default)
+                    parts.append(struct.pack('!cI', JSON_VECTOR, len(data)))
+                    parts.append(data)
+
+    return ''.join(parts)
+
+
+def decode(row, as_array=False):
+    """ Return the record stored in row, in either format, as a dict
+    with a 'type' key. Keys come back raw.
+
+    Vectors are returned as lists, or as numpy arrays if as_array is set.
+    """
+    if row[:1] == '{':
+        return _decode_json(row)
+
+    try:
+        version, type_code = struct.unpack_from('!BB', row)
+    except struct.error:
+        raise DecodeError("row is too short")
+    if version != FORMAT_VERSION:
+        raise DecodeError("unknown format version %d" % version)
+    if type_code not in _TYPE_NAMES:
+        raise DecodeError("unknown record type %d" % type_code)
+
+    type_name = _TYPE_NAMES[type_code]
+    record = {'type': type_name}
+    offset = 2
+
+    try:
+        for name, kind in SCHEMAS[type_name][1]:
+            if kind == 'key':
+                value = row[offset:offset + KEY_LENGTH]
+                offset += KEY_LENGTH
+
+            elif kind == 'str':
+                length, = struct.unpack_from('!I', row, offset)
+                offset += 4
+                if length == NONE_LENGTH:
+                    value = None
+                else:
+                    value = row[offset:offset + length].decode('utf-8')
+                    offset += length
+
+            elif kind == 'int':
+                value, = struct.unpack_from('!i', row, offset)
+                offset += 4
+                if value == -1:
+                    value = None
+
+            elif kind == 'vector':
+                precision, length = struct.unpack_from('!cI', row, offset)
+                offset += 5
+                if precision == '\x00':
+                    value = None
+                elif precision == JSON_VECTOR:
+                    value = simplejson.loads(row[offset:offset + length])
+                    offset += length
+                else:
+                    value = frombuffer(row, _DTYPES[precision], length, offset)
+                    offset += value.nbytes
+                    if not as_array:
+                        value = value.tolist()
+
+            record[name] = value
+    except (struct.error, ValueError, KeyError), e:
+        raise DecodeError("truncated or corrupt %s record: %s" % (type_name, e))
+
+    return record
+
+
+def _flat_array(value, precision):
+    """ Return value as a 1-D array of the given precision, or None if it
+    isn't a flat sequence of numbers.
+    """
+    if isinstance(value, basestring):
+        return None
+    try:
+        for item in value:
+            # numpy would happily parse '1.5'
+            if isinstance(item, basestring):
+                return None
+        array = asarray(value, dtype=_DTYPES[precision])
+    except (TypeError, ValueError):
+        return None
+    if array.ndim != 1:
+        return None
+    return array
+
+def _json_default(obj):
+    if isinstance(obj, ndarray):
+        return obj.tolist()
+    raise TypeError("%r is not JSON serializable" % (obj,))
+
+def _decode_json(row):
+    record = simplejson.loads(row)
+    for name in _HEX_FIELDS:
+        if record.get(name) is not None:
+            record[name] = record[name].decode('hex')
+    return record
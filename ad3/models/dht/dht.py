@@ -1,5 +1,4 @@
 import ad3.models.abstract
-import simplejson
 import hashlib
 import urllib
 import tempfile
@@ -16,22 +15,38 @@ from time import time
 from sets import Set
 from twisted.internet import defer
 from twisted.internet import reactor
-from functools import partial
+from numpy import array, zeros
+from cache import ObjectCache
+from index import TupleIndex
+import codec
 
 import logging
 logger = logging.getLogger('3ad')
 
 offload_result_timeout = 300 # 5 minutes; client must download and process vector in this time
-offload_poll_wait = 10 # 10 seconds between node.pollOffloadedCalculation calls
+# The node we offload to reports back as soon as it's done; polling with
+# node.pollOffloadedCalculation is only a fallback in case that gets lost.
+offload_poll_wait = 30 # seconds before the first poll
+offload_poll_max_wait = 120 # the wait doubles after every poll, up to this
 
 class KeyAggregator(object):
     # Once initialized with a list of tuples to match against
+    # the KeyAggregator reads every tuple template at once, and
+    # intersects the key lists as they arrive. If the intersection
+    # becomes empty, there's no point in waiting for the remaining
+    # reads, so it calls back immediately with no keys.
     def __init__(self, net_handler, tuple_list):
         self.net_handler = net_handler
         self.tuple_list = tuple_list
-        self.key_lists = []
+        self.keys = None
+        self.pending = []
+        self.outer_df = None
 
     def got_tuples(self, tuples, dTuple):
+        if self.outer_df.called:
+            # We've already short-circuited. Ignore late arrivals.
+            return None
+
         # Got a new list of tuples...
         if tuples is None:
             tuples = []
@@ -39,102 +54,134 @@ class KeyAggregator(object):
         else:
             logger.debug("KeyAggregator found keys on network for %r", dTuple)
 
-        keys = [t[1] for t in tuples]
+        keys = Set([t[1] for t in tuples])
         logger.debug("KeyAggregator Got Key List: %r", keys)
 
-        self.key_lists.append(keys)
+        # Intersect with the smallest set on the outside.
+        if self.keys is None:
+            self.keys = keys
+        elif len(keys) < len(self.keys):
+            self.keys = keys.intersection(self.keys)
+        else:
+            self.keys = self.keys.intersection(keys)
 
-    def done(self, val):
-        # Get the maximum intersecting set of keys in all tuples.
-        if not self.key_lists:
-            return []
+        if not self.keys:
+            logger.debug("KeyAggregator short-circuiting on %r", dTuple)
+            self.done(None)
 
-        keys = Set(self.key_lists[0])
+        return None
 
-        for ks in self.key_lists[1:]:
-            keys = keys.intersection(ks)
+    def done(self, val):
+        if self.outer_df.called:
+            return None
 
-        return list(keys)
+        # Stop waiting on any reads still in progress.
+        for df in self.pending:
+            if not df.called and hasattr(df, 'cancel'):
+                df.cancel()
+
+        self.outer_df.callback(list(self.keys or []))
+        return None
 
     def go(self):
         # for each search tuple, run our got_tuples function on the resulting tuple rows
-        dfs = []
+        self.outer_df = defer.Deferred()
+
         for dTuple in self.tuple_list:
             df = self.net_handler.dht_get_tuples(dTuple)
             df.addCallback(self.got_tuples, dTuple)
+            self.pending.append(df)
 
-        list_df = defer.DeferredList(dfs)
+        list_df = defer.DeferredList(self.pending, consumeErrors=True)
         list_df.addCallback(self.done)
 
-        return list_df
+        return self.outer_df
 
 
 class ObjectAggregator(object):
     # Once initialized with a list of hash keys
     # the ObjectAggregator can be instructed to create a
     # list of objects represented by the data at those keys
-    # and asynchronously pass that list to a callback function
+    # and asynchronously pass that list to a callback function.
+    #
+    # Objects are fetched in bulk. Keys that couldn't be found before
+    # the network handler's read timeout are left in self.missing.
 
     def __init__(self, net_handler, key_list):
         self.net_handler = net_handler
         self.key_list = key_list
         self.objects = []
+        self.missing = []
 
     def go(self):
-        outer_df = defer.Deferred()
-
-        def got_value(value):
-            # append this value to our list
-            obj = self.net_handler.obj_from_row(value)
-            got_obj(obj)
-
-        def got_obj(obj):
-            self.objects.append(obj)
-
-            # if we have got all the values we asked for
-            # call the callback function
-            if len(self.objects) == len(self.key_list):
-                outer_df.callback(self.objects)
-
-        # for each key, run our got_value function on the value row
-        for key in self.key_list:
-#            logger.debug("-> Searching for key.. %r", key.encode('hex'))
-            o = self.net_handler.cache_get_obj(key)
-            if o is not None:
-                got_obj(o)
-            else:
-                df = self.net_handler.dht_get_value(key)
-                df.addCallback(got_value)
-
-        return outer_df
+        def got_objects(result):
+            objects, missing = result
+            self.objects.extend(objects)
+            self.missing = missing
+            if missing:
+                logger.warn("ObjectAggregator could not find %d of %d keys",
+                        len(missing), len(self.key_list))
+            return self.objects
+
+        df = self.net_handler.get_objects(self.key_list)
+        df.addCallback(got_objects)
+        return df
 
 
 class NetworkHandler(object):
-    def __init__(self, node):
+    """
+    Attributes:
+        node            the local Node
+        cache           the ObjectCache of decoded objects; pass your own
+                        to change its budgets or time to live
+        write_limit     maximum number of concurrent writes in bulk operations
+        read_timeout    seconds a bulk read waits before giving up
+        index           the TupleIndex answering template reads locally
+    """
+    def __init__(self, node, write_limit=32, read_timeout=30, cache=None,
+            index_ttl=30):
         self.node = node
-        self._cache = {}
+        if cache is None:
+            cache = ObjectCache(ttls={
+                Plugin: None,
+                PluginOutput: 3600,
+                AudioFile: 300,
+                Tag: 30,
+            })
+        self.cache = cache
+        self.index = TupleIndex(index_ttl)
+        # maximum number of concurrent writes issued by bulk operations
+        self.write_limit = write_limit
+        # seconds a bulk read waits before giving up on the missing keys
+        self.read_timeout = read_timeout
 
     def obj_from_row(self, row):
         logger.debug("-> OBJ FROM ROW %r", row)
-        h = simplejson.loads(row)
+        try:
+            h = codec.decode(row)
+        except codec.DecodeError, e:
+            logger.warn("Could not decode row: %s", e)
+            return None
 
         if h['type'] == "plugin":
-            o = Plugin(h['name'], h['module_name'], h['key'].decode('hex'))
+            o = Plugin(h['name'], h['module_name'], h['key'])
 
         elif h['type'] == "plugin_output":
-            o = PluginOutput(h['vector'], h['plugin_key'], h['audio_key'], h['key'].decode('hex'))
+            o = PluginOutput(h['vector'], h['plugin_key'], h['audio_key'], h['key'])
 
         elif h['type'] == "tag":
-            o = Tag(h['name'], h['vector'], h['key'].decode('hex'))
+            o = Tag(h['name'], h['vector'], h['key'],
+                    h.get('count'), h.get('vector_sum'))
 
         elif h['type'] == "audio_file":
-            o = AudioFile(h['file_name'], h['vector'], h['user_name'], h['key'].decode('hex'))
+            o = AudioFile(h['file_name'], h['vector'], h['user_name'], h['key'],
+                    h.get('content_digest'))
 
         else:
             o = None
 
         if o is not None:
-            self.cache_store_obj(h['key'].decode('hex'), o)
+            self.cache_store_obj(h['key'], o)
 
         return o
 
@@ -166,6 +213,80 @@ class NetworkHandler(object):
         return df
 
 
+    def local_get_value(self, key):
+        """
+        Return the value stored at key on this node (in its data store, or
+        its value cache) without going to the network, or None.
+        """
+        return self.node._localValue(key)
+
+
+    def get_value(self, key):
+        """
+        Like dht_get_value, but answers from this node if it can.
+        """
+        value = self.local_get_value(key)
+        if value is not None:
+            return defer.succeed(value)
+        return self.dht_get_value(key)
+
+
+    def dht_get_values(self, keys, timeout=None):
+        """
+        Fetch the values for many keys at once.
+
+        Immediately returns a deferred that will return a tuple of
+        (dict of key => value, list of keys that weren't found).
+        """
+        if timeout is None:
+            timeout = self.read_timeout
+
+        df = self.node.iterativeFindValues(keys, timeout)
+        return df
+
+
+    def get_objects(self, keys, timeout=None):
+        """
+        Return the objects stored at keys, from the object cache where
+        possible, and with one bulk fetch for everything else. Duplicate
+        keys are collapsed.
+
+        Immediately returns a deferred that will return a tuple of
+        (list of objects, list of keys that weren't found).
+        """
+        objects = []
+        fetch = []
+        seen = Set()
+        for key in keys:
+            if key in seen:
+                continue
+            seen.add(key)
+
+            o = self.cache_get_obj(key)
+            if o is not None:
+                objects.append(o)
+            else:
+                fetch.append(key)
+
+        def got_values(result):
+            values, missing = result
+            for key in fetch:
+                if key in values:
+                    o = self.obj_from_row(values[key])
+                    if o is not None:
+                        objects.append(o)
+                        continue
+                    missing.append(key)
+            return (objects, missing)
+
+        if not fetch:
+            return defer.succeed((objects, []))
+
+        df = self.dht_get_values(fetch, timeout)
+        df.addCallback(got_values)
+        return df
+
+
     def dht_store_value(self, key, value):
         def success(result):
             logger.debug("dht_store_value: %s => %r on %r", key.encode('hex'), value, result)
@@ -177,45 +298,101 @@ class NetworkHandler(object):
         return df
 
 
-    def dht_get_tuples(self, dTuple):
+    def dht_get_tuples(self, dTuple, fresh=False):
+        """
+        Return every tuple matching dTuple, from the local index if it is
+        authoritative for dTuple, or from the network. With fresh set, the
+        network is always asked.
+        """
         def success(result):
             """
             @type result  tuple or None
             """
             logger.debug("dht_get_tuples: %r %r", result, dTuple)
+            self.index.learn(dTuple, result, token)
             return result
 
         def error(failure):
             logger.debug("dht_get_tuples: %r, %s", dTuple, failure.getErrorMessage())
+            self.index.end_read(token)
             return None
 
+        if fresh:
+            result = None
+        else:
+            result = self.index.read(dTuple)
+        if result is not None:
+            logger.debug("-> found %d tuples for %r in the local index", len(result), dTuple)
+            return defer.succeed(result)
+
         logger.debug("-> searching for tuples based on %r", dTuple)
+        token = self.index.begin_read()
         df = self.node.readIfExists(dTuple, 0)
-        df.addCallback(success)
-        df.addErrback(error)
+        df.addCallbacks(success, error)
         return df
 
-    def dht_remove_tuples(self, dTuple):
-        logger.debug("Removing tuples matching %r", dTuple)
-        df = defer.Deferred()
-        outer_df = defer.Deferred()
-
-        def done(result):
-            outer_df.callback(result)
+    def dht_remove_tuples(self, dTuple, limit=None):
+        """
+        Remove every tuple matching dTuple. The matches are collected with
+        a network read (never from the local index, which may be missing
+        tuples other nodes wrote recently), then each one is removed, with
+        at most limit (by default, self.write_limit) removals in progress at
+        any one time. This repeats until a read finds nothing more to
+        remove, or a round fails to remove anything.
+
+        Immediately returns a deferred that will return the number of
+        tuples removed.
+        """
+        if limit is None:
+            limit = self.write_limit
 
-        def get_next_tuple(result):
-            if result is not None:
-                df.addCallback(get_next_tuple)
-                df_g = self.node.getIfExists(dTuple)
-                return df_g
-            else:
-                df.addCallback(done)
-                return None
+        logger.debug("Removing tuples matching %r", dTuple)
+        sem = defer.DeferredSemaphore(limit)
+
+        def removed(result):
+            if result is None:
+                # someone else got there first
+                return 0
+            self.index.remove(result)
+            return 1
+
+        def failed(failure, match):
+            logger.debug("Could not remove %r: %s", match, failure.getErrorMessage())
+            return 0
+
+        def remove_one(match):
+            # a template with every field filled in matches only this tuple
+            df = self.node.getIfExists(tuple(match))
+            df.addCallback(removed)
+            df.addErrback(failed, match)
+            return df
 
-        df.addCallback(get_next_tuple)
-        df.callback('go')
+        totals = [0]
+
+        def count(results):
+            removed = sum([value for success, value in results if success])
+            totals[0] += removed
+            if removed == 0:
+                logger.debug("Removed %d tuples matching %r", totals[0], dTuple)
+                return totals[0]
+            # More may have been written while we were removing.
+            return read()
+
+        def got_tuples(tuples):
+            if not tuples:
+                logger.debug("Removed %d tuples matching %r", totals[0], dTuple)
+                return totals[0]
+            dfs = [sem.run(remove_one, match) for match in tuples]
+            list_df = defer.DeferredList(dfs)
+            list_df.addCallback(count)
+            return list_df
+
+        def read():
+            df = self.dht_get_tuples(dTuple, fresh=True)
+            df.addCallback(got_tuples)
+            return df
 
-        return outer_df
+        return read()
 
     def dht_store_tuple(self, dTuple):
         def success(result):
@@ -228,12 +405,31 @@ class NetworkHandler(object):
             pass
 
         logger.debug("-> Attempting to store tuple: %r", dTuple)
+        self.index.add(dTuple)
         df = self.node.put(dTuple, trackUsage=False)
         df.addCallback(success)
         df.addErrback(error)
         return df
 
 
+    def dht_store_tuples(self, tuple_list, limit=None):
+        """
+        Store every tuple in tuple_list, with at most limit (by default,
+        self.write_limit) writes in progress at any one time.
+
+        Immediately returns a deferred that will return once every write
+        has finished.
+        """
+        if limit is None:
+            limit = self.write_limit
+
+        logger.debug("-> Attempting to store %d tuples", len(tuple_list))
+        sem = defer.DeferredSemaphore(limit)
+        dfs = [sem.run(self.dht_store_tuple, t) for t in tuple_list]
+        list_df = defer.DeferredList(dfs)
+        return list_df
+
+
     def get_objects_matching_tuples(self, tuple_list):
         """
         Return a list of the appropriate objects for each object row
@@ -287,21 +483,16 @@ class NetworkHandler(object):
         and its lifetime has not expired
         return it. else return None
         """
-        if key in self._cache:
-            entry = self._cache[key]
-            if int(time()) < entry[0]:
-                logger.debug("-> Fetching object from the cache %r TTL: %d s", entry[1], int(time()) - entry[0])
-                return entry[1]
-
-        return None
+        o = self.cache.get(key)
+        if o is not None:
+            logger.debug("-> Fetching object from the cache %r", o)
+        return o
 
     def cache_store_obj(self, key, obj):
         """
         store the object in our cache
-        with an end of life timestamp
         """
-        lifetime = int(time()) + 300
-        self._cache[key] = (lifetime, obj)
+        self.cache.put(key, obj)
 
 
 _network_handler = None
@@ -355,12 +546,14 @@ class SaveableModel(object):
             return df
 
         def save_value(val):
-            my_hash['key'] = self.key.encode('hex')
-            my_string = simplejson.dumps(my_hash)
+            my_hash['key'] = self.key
+            my_string = codec.encode(my_hash)
             df = _network_handler.dht_store_value(self.key, my_string)
             return df
 
         def done(val):
+            # we know better than whatever was cached
+            _network_handler.cache_store_obj(self.key, self)
             outer_df.callback(self)
 
         if self.key is None:
@@ -419,24 +612,25 @@ class AudioFile(ad3.models.abstract.AudioFile, SaveableModel):
         name
         vector
         key
+        content_digest  hex sha1 of the file's contents, once known
 
     Method:
         getKey
     """
 
-    def __init__(self, file_name, vector = None, user_name = "", key = None):
+    def __init__(self, file_name, vector = None, user_name = "", key = None, content_digest = None):
         ad3.models.abstract.AudioFile.__init__(self, file_name)
 
         self.vector = vector
         self.key = key
         self.user_name = user_name
+        self.content_digest = content_digest
 
     def __repr__(self):
         return "<AudioFile('%s', '%s')>" % (self.file_name, self.user_name)
 
     def _get_key(self):
-        r = _network_handler.hash_function("audio_file_" + self.file_name + self.user_name)
-        return r
+        return _audio_file_key(self.file_name, self.user_name)
 
     def _get_tuple(self):
         my_tuple = ("audio_file", self.key, self.file_name, self.user_name)
@@ -447,6 +641,7 @@ class AudioFile(ad3.models.abstract.AudioFile, SaveableModel):
             'file_name': self.file_name,
             'vector': self.vector,
             'user_name': self.user_name,
+            'content_digest': self.content_digest,
             'type': 'audio_file'
         }
         df = self._save(my_hash)
@@ -460,27 +655,99 @@ class Tag(ad3.models.abstract.Tag, SaveableModel):
         name
         vector
         key
+        count       number of files with this tag, or None if unknown
+        vector_sum  sum of the vectors of those files
+
+    count and vector_sum are kept up to date by apply_tag_to_file,
+    remove_tag_from_file and replace_file_vector, so that a mean tag vector
+    is cheap to refresh.
+
+    A Tag created here rather than read from the network doesn't know its
+    statistics. Changes made to it are kept aside, and added to whatever
+    is stored when it is saved.
+
+    The statistics are read, modified and written back without any
+    locking, so two nodes (or two Tag objects) updating the same tag at
+    once can lose one of the updates. update_tag_vectors(full=True)
+    rebuilds them from the tagged files, and should be run now and then
+    on networks where tags are applied from several nodes.
     """
 
-    def __init__(self, name, vector = None, key = None):
+    def __init__(self, name, vector = None, key = None, count = None, vector_sum = None):
         self.name = name
         self.vector = vector
         self.key = key
+        self.count = count
+        self.vector_sum = vector_sum
+
+        # changes made while count is unknown; see _update_tag_stats
+        self._pending_count = 0
+        self._pending_sum = None
 
     def _get_key(self):
-        return _network_handler.hash_function("tag_" + self.name)
+        return _tag_key(self.name)
 
     def _get_tuple(self):
         my_tuple = ("tag", self.key, self.name)
         return my_tuple
 
+    def _merge_stats(self, result):
+        """ Take the statistics stored for this tag, plus any changes made
+        to this object since. A tag that isn't stored yet starts from zero.
+        """
+        values, missing = result
+        stored = None
+        if self.get_key() in values:
+            stored = _network_handler.obj_from_row(values[self.get_key()])
+
+        if stored is None:
+            self.count, self.vector_sum = 0, None
+        elif stored.count is not None:
+            self.count, self.vector_sum = stored.count, stored.vector_sum
+        else:
+            logger.debug("Statistics for %r are unknown", self)
+
+        pending = self._pending_sum
+        if self.count is None or pending is None:
+            pass
+        elif not self.vector_sum:
+            self.vector_sum = pending
+        elif len(self.vector_sum) == len(pending):
+            self.vector_sum = (array(self.vector_sum, dtype=float) + pending).tolist()
+        else:
+            logger.debug("Can't merge statistics for %r; marking as unknown", self)
+            self.count, self.vector_sum = None, None
+
+        if self.count is not None:
+            self.count += self._pending_count
+        self._pending_count = 0
+        self._pending_sum = None
+
     def save(self):
-        my_hash = {
-            'name': self.name,
-            'vector': self.vector,
-            'type': 'tag'
-        }
-        df = self._save(my_hash)
+        """ Save the tag. If its statistics are unknown, those stored on
+        the network are read first and kept (see _merge_stats).
+        """
+        def save_hash(val):
+            my_hash = {
+                'name': self.name,
+                'vector': self.vector,
+                'count': self.count,
+                'vector_sum': self.vector_sum,
+                'type': 'tag'
+            }
+            return self._save(my_hash)
+
+        def failed(failure):
+            # Unknown statistics get rebuilt, so that is safe to save.
+            logger.warn("Could not read statistics for %r: %s", self,
+                    failure.getErrorMessage())
+
+        if self.count is not None:
+            return save_hash(None)
+
+        df = _network_handler.dht_get_values([self.get_key()])
+        df.addCallbacks(self._merge_stats, failed)
+        df.addCallback(save_hash)
         return df
 
 
@@ -493,6 +760,10 @@ class PluginOutput(ad3.models.abstract.PluginOutput, SaveableModel):
         plugin_key
         file_key
         key
+
+    The key is derived from the plugin and audio file keys, so there is
+    one PluginOutput per plugin per file: it can be fetched without a
+    tuple search, and recalculating it overwrites the old one.
     """
 
     def __init__(self, vector, plugin_key = None, audio_key = None,  key = None):
@@ -502,58 +773,36 @@ class PluginOutput(ad3.models.abstract.PluginOutput, SaveableModel):
         self.key = key
 
     def _get_key(self):
-        return _network_handler.hash_function("plugin_output_"+str(self.vector))
+        return _plugin_output_key(self.plugin_key, self.audio_key)
+
+    def _get_tuples(self):
+        return [
+            # a plugin_output row
+            ("plugin_output", self.key, self.plugin_key, self.audio_key),
+            # a plugin row for cross referencing
+            ("plugin", self.plugin_key, "plugin_output", self.key),
+            # an audio_file row for cross referencing
+            ("audio_file", self.audio_key, "plugin_output", self.key),
+        ]
+
+    def _get_value(self):
+        my_hash = {'vector': self.vector,
+                   'key': self.key,
+                   'plugin_key': self.plugin_key,
+                   'audio_key': self.audio_key,
+                   'type': 'plugin_output'}
+        return codec.encode(my_hash)
 
     def save(self):
-        # We've got a bunch of stuff to do. Don't call __save(), just do it.
-        outer_df = defer.Deferred()
-        df = defer.Deferred()
-
-        def done(val):
-            outer_df.callback(self)
-
-        def save_audio_tuple(val):
-            # make an audio_file row for cross referencing
-            audio_tuple = ("audio_file", self.audio_key, "plugin_output", self.key)
-            df = _network_handler.dht_store_tuple(audio_tuple)
-            return df
-
-        def save_plugin_tuple(val):
-            # make a plugin row for cross referencing
-            plugin_tuple = ("plugin", self.plugin_key, "plugin_output", self.key)
-            df = _network_handler.dht_store_tuple(plugin_tuple)
-            return df
-
-        def save_my_tuple(val):
-            # store a plugin_output row
-            my_tuple = ("plugin_output", self.key, self.plugin_key, self.audio_key)
-            df =_network_handler.dht_store_tuple(my_tuple)
-            return df
+        """ Save this object to the DHT. The value and its tuples are
+        written concurrently.
 
-        def save_value(val):
-            # store the object state
-            my_hash = {'vector': self.vector,
-                       'key': self.key.encode('hex'),
-                       'plugin_key': self.plugin_key.encode('hex'),
-                       'audio_key': self.audio_key.encode('hex'),
-                       'type': 'plugin_output'}
-            my_string = simplejson.dumps(my_hash)
-            df = _network_handler.dht_store_value(self.key, my_string)
-            return df
-
-
-        if self.key is None:
-            self.key = self._get_key()
-            # chain our tuple saving procedures, so they don't happen at the same time
-            df.addCallback(save_my_tuple)
-            df.addCallback(save_plugin_tuple)
-            df.addCallback(save_audio_tuple)
-
-        df.addCallback(save_value)
-        df.addCallback(done)
-        df.callback(None)
-
-        return outer_df
+        Immediately returns a deferred which will return this object,
+        after it has been saved.
+        """
+        df = save_plugin_outputs([self])
+        df.addCallback(lambda outputs: self)
+        return df
 
 
 
@@ -579,18 +828,47 @@ def get_tags(name = None, audio_file = None, guessed_file = None):
     df = _network_handler.get_objects_matching_tuples(search_tuples)
     return df
 
+def _tag_key(name):
+    return _network_handler.hash_function("tag_" + name)
+
 def get_tag(name):
     """ Returns a deferred, which will be called back with a single Tag object.
     If no such Tag exists in the data store, passes None to the callback.
 
+    The Tag is fetched directly by its key. Tags saved before keys were
+    derived from the name (or whose fetch timed out) can only be found by
+    a tuple search, which is done if the key misses.
+
     @param name: the name of the tag object to return
     @type  name: unicode
     """
-    search_tuples = [("tag", None, name)]
-    df = _network_handler.get_object_matching_tuples(search_tuples)
+    def got_objects(result):
+        objects, missing = result
+        for o in objects:
+            if isinstance(o, Tag) and o.name == name:
+                return o
+
+        logger.debug("Tag %r not found by key; searching", name)
+        df = _network_handler.get_object_matching_tuples([ ("tag", None, name) ])
+        return df
+
+    df = _network_handler.get_objects([_tag_key(name)])
+    df.addCallback(got_objects)
     return df
 
+def _plugin_output_key(plugin_key, audio_key):
+    return _network_handler.hash_function("plugin_output_" + plugin_key + audio_key)
+
 def get_plugin_outputs(audio_file=None, plugin=None):
+    """ Returns a deferred, which will be called back with a list of
+    PluginOutput objects.
+
+    Given an audio_file, its outputs are fetched directly by key, for the
+    provided plugin or every plugin. Outputs saved before keys were
+    derived from the plugin and file can only be found by a tuple search,
+    which is done if any plugin's output isn't found by key. Only one
+    output per plugin is returned, preferring the one found by key.
+    """
     if audio_file is not None:
         audio_key = audio_file.get_key()
     else:
@@ -601,12 +879,52 @@ def get_plugin_outputs(audio_file=None, plugin=None):
         plugin_key = None
 
     search_tuples = [ ("plugin_output", None, plugin_key, audio_key) ]
+
+    def got_objects(result):
+        objects, missing = result
+        if not missing:
+            return objects
+
+        def merge(searched):
+            seen = Set()
+            merged = []
+            for po in objects + searched:
+                if po.plugin_key not in seen:
+                    seen.add(po.plugin_key)
+                    merged.append(po)
+            return merged
+
+        logger.debug("%d plugin outputs for %r not found by key; searching",
+                len(missing), audio_file)
+        df = _network_handler.get_objects_matching_tuples(search_tuples)
+        df.addCallback(merge)
+        return df
+
+    if audio_key is not None:
+        if plugin is not None:
+            plugin_keys = [plugin_key]
+        else:
+            plugin_keys = [p.get_key() for p in plugins]
+        keys = [_plugin_output_key(k, audio_key) for k in plugin_keys]
+
+        df = _network_handler.get_objects(keys)
+        df.addCallback(got_objects)
+        return df
+
     df = _network_handler.get_objects_matching_tuples(search_tuples)
     return df
 
 def get_plugin_output(audio_file, plugin):
-    search_tuples = [ ("plugin_output", None, plugin.get_key(), audio_file.get_key()) ]
-    df = _network_handler.get_objects_matching_tuples(search_tuples)
+    """ Returns a deferred, which will be called back with the
+    PluginOutput of plugin for audio_file, or None.
+    """
+    def pick_one(obj_list):
+        if obj_list:
+            return obj_list[0]
+        return None
+
+    df = get_plugin_outputs(audio_file, plugin)
+    df.addCallback(pick_one)
     return df
 
 def get_plugins(name = None, module_name = None, plugin_output = None):
@@ -683,9 +1001,69 @@ def get_audio_files(file_name=None, user_name=None, tag=None, guessed_tag=None,
     df = _network_handler.get_objects_matching_tuples(search_tuples)
     return df
 
+def _audio_file_key(file_name, user_name):
+    return _network_handler.hash_function("audio_file_" + file_name + user_name)
+
+def get_audio_files_by_name(file_names, user_name):
+    """ Returns a deferred, which will be called back with a list of the
+    AudioFile objects that exist for file_names, fetched directly by key in
+    one bulk read.
+
+    Files not found by key (saved before keys were derived from the name,
+    or whose fetch timed out) are searched for by their own tuple, at most
+    write_limit searches at a time. The search never widens to the rest of
+    user_name's files.
+
+    @param file_names: the names of the files to return
+    @type  file_names: list of unicode
+
+    @param user_name: the user the files belong to
+    @type  user_name: unicode
+    """
+    wanted = Set(file_names)
+
+    def matching(objects):
+        return [o for o in objects if isinstance(o, AudioFile) and
+                o.file_name in wanted and o.user_name == user_name]
+
+    def got_objects(result):
+        found = matching(result[0])
+        missing = wanted - Set([o.file_name for o in found])
+        if not missing:
+            return found
+
+        logger.debug("%d audio files not found by key; searching", len(missing))
+        searched = {}
+
+        def got_searched(objects):
+            for o in matching(objects):
+                if o.file_name in missing:
+                    searched.setdefault(o.file_name, o)
+
+        sem = defer.DeferredSemaphore(_network_handler.write_limit)
+        dfs = []
+        for file_name in missing:
+            template = ("audio_file", None, file_name, user_name)
+            df = sem.run(_network_handler.get_objects_matching_tuples, [template])
+            df.addCallback(got_searched)
+            dfs.append(df)
+
+        list_df = defer.DeferredList(dfs)
+        list_df.addCallback(lambda val: found + searched.values())
+        return list_df
+
+    keys = [_audio_file_key(file_name, user_name) for file_name in wanted]
+    df = _network_handler.get_objects(keys)
+    df.addCallback(got_objects)
+    return df
+
 def get_audio_file(file_name=None, user_name=None, tag=None, guessed_tag=None, plugin_output=None):
-    """ Returns a deferred, which will be called back with a list of AudioFile objects.
-    By default returns all audio files.
+    """ Returns a deferred, which will be called back with a single AudioFile
+    object, or None.
+
+    Given only a file_name and user_name, the file is fetched directly by
+    its key, falling back to a tuple search if that misses. Otherwise, the
+    first file matching a tuple search is returned.
 
     @param file_name: if provided, returns only files with a matching file name
     @type  file_name: unicode
@@ -702,15 +1080,29 @@ def get_audio_file(file_name=None, user_name=None, tag=None, guessed_tag=None, p
     @param plugin_output: if provided, returns only the file associated with this output
     @type  plugin_output: PluginOutput object
     """
-    search_tuples = [ ("audio_file", None, file_name, user_name) ]
-    if tag is not None:
-        search_tuples.append( ("audio_file", None, "tag", tag.get_key()) )
-    if guessed_tag is not None:
-        search_tuples.append( ("audio_file", None, "guessed_tag", guessed_tag.get_key()) )
-    if plugin_output is not None:
-        search_tuples.append( ("audio_file", None, "plugin_output", plugin_output.get_key()) )
+    def search(val=None):
+        search_tuples = [ ("audio_file", None, file_name, user_name) ]
+        if tag is not None:
+            search_tuples.append( ("audio_file", None, "tag", tag.get_key()) )
+        if guessed_tag is not None:
+            search_tuples.append( ("audio_file", None, "guessed_tag", guessed_tag.get_key()) )
+        if plugin_output is not None:
+            search_tuples.append( ("audio_file", None, "plugin_output", plugin_output.get_key()) )
+
+        df = _network_handler.get_object_matching_tuples(search_tuples)
+        return df
 
-    df = _network_handler.get_object_matching_tuples(search_tuples)
+    def pick_one(files):
+        if files:
+            return files[0]
+        return None
+
+    if file_name is None or user_name is None or \
+            tag is not None or guessed_tag is not None or plugin_output is not None:
+        return search()
+
+    df = get_audio_files_by_name([file_name], user_name)
+    df.addCallback(pick_one)
     return df
 
 
@@ -724,6 +1116,67 @@ def save(obj):
     df = obj.save()
     return df
 
+def save_plugin_outputs(outputs):
+    """ Save many PluginOutputs, typically every plugin's output for one
+    file, as a single unit: every value and cross-reference tuple is
+    written at once, rather than four writes in a row per output.
+
+    An output that already exists is overwritten in place; only its value
+    is written.
+
+    @param outputs: the outputs to save
+    @type  outputs: list of PluginOutput, or a dict whose values are
+                    PluginOutputs
+
+    Immediately returns a deferred that will return the list of outputs,
+    once they have all been saved.
+    """
+    if isinstance(outputs, dict):
+        outputs = outputs.values()
+    else:
+        outputs = list(outputs)
+
+    existing = Set()
+
+    def got_existing(tuples):
+        for t in tuples or []:
+            existing.add(t[3])
+
+    def find_existing():
+        # One search per file, for the outputs it already has.
+        dfs = []
+        for audio_key in Set([po.audio_key for po in outputs]):
+            audio_tuple = ("audio_file", audio_key, "plugin_output", None)
+            df = _network_handler.dht_get_tuples(audio_tuple)
+            df.addCallback(got_existing)
+            dfs.append(df)
+        return defer.DeferredList(dfs)
+
+    def save(val):
+        tuples = []
+        dfs = []
+        for po in outputs:
+            if po.key is None:
+                po.key = po._get_key()
+            if po.key not in existing:
+                tuples.extend(po._get_tuples())
+
+            df = _network_handler.dht_store_value(po.key, po._get_value())
+            df.addCallback(lambda val, po=po: _network_handler.cache_store_obj(po.key, po))
+            dfs.append(df)
+
+        logger.debug("-> saving %d plugin outputs (%d tuples)", len(outputs), len(tuples))
+        if tuples:
+            dfs.append(_network_handler.dht_store_tuples(tuples))
+
+        list_df = defer.DeferredList(dfs)
+        list_df.addCallback(lambda val: outputs)
+        return list_df
+
+    df = find_existing()
+    df.addCallback(save)
+    return df
+
 def special_generate_plugin_vectors(audio_file):
     """ Attempts to farm out vector calculation over the network.
 
@@ -746,18 +1199,30 @@ def special_generate_plugin_vectors(audio_file):
     }
 
     outer_df = defer.Deferred()
+    node = _network_handler.node
+    poll = {'wait': offload_poll_wait, 'timer': None}
+
+    def finish(vectors):
+        if outer_df.called:
+            return
+        node.stopWaitingForOffload(struct['file_key'])
+        if poll['timer'] is not None and poll['timer'].active():
+            poll['timer'].cancel()
+        outer_df.callback(vectors)
 
     def fail():
-        outer_df.callback(None)
+        finish(None)
 
     def succeed(vectors):
-        outer_df.callback(vectors)
+        finish(vectors)
 
-    def got_poll_response(response):
+    def got_result(response):
         # response dict will be a copy of the entry in the contact's
         # node.computations dict. As such, it will have the following fields:
         # 'complete', 'vectors', 'failed', 'downloaded'
         #  bool        dict       bool      bool
+        if outer_df.called:
+            return None
 
         if not isinstance(response, dict):
             # Oh noes, error condition!
@@ -766,10 +1231,10 @@ def special_generate_plugin_vectors(audio_file):
             return None
 
         if response['failed']:
-            logger.debug("Poll: failed")
+            logger.debug("Offload: failed")
             fail()
         elif response['complete']:
-            logger.debug("Poll: complete!")
+            logger.debug("Offload: complete!")
             succeed(response['vectors'])
         else:
             # schedule another poll
@@ -779,21 +1244,32 @@ def special_generate_plugin_vectors(audio_file):
         return None
 
     def send_poll():
+        poll['timer'] = None
         if int(time()) - struct['timestamp'] > offload_result_timeout:
             # timed out. just calculate it yourself
             logger.debug("Offloaded transaction timed out. Computing locally.")
             fail()
         else:
             logger.debug("Polling...")
-            # execute a poll and call the "got_poll_response" method when it's done
-            df = _network_handler.node.pollOffloadedCalculation(struct)
-            df.addBoth(got_poll_response)
+            # execute a poll and call the "got_result" method when it's done
+            df = node.pollOffloadedCalculation(struct)
+            df.addBoth(got_result)
+
+    def schedule_poll():
+        # Back off: the result should be pushed to us anyway.
+        remaining = offload_result_timeout - (int(time()) - struct['timestamp'])
+        wait = max(0, min(poll['wait'], remaining + 1))
+        poll['wait'] = min(poll['wait'] * 2, offload_poll_max_wait)
+        poll['timer'] = reactor.callLater(wait, send_poll)
 
     def got_response(response):
         if response == "OK":
-            # Found a node that accepted our offload request!
-            # start the polling loop here.
+            # Found a node that accepted our offload request! It will
+            # report back when it's done; poll now and then in case it
+            # doesn't.
             logger.debug("Offload request accepted.")
+            df = node.waitForOffloadedCalculation(struct)
+            df.addCallback(got_result)
             schedule_poll()
         else:
             # Couldn't find a node to accept our offload request.
@@ -801,14 +1277,88 @@ def special_generate_plugin_vectors(audio_file):
             logger.debug("Offload request rejected.")
             fail()
 
-    schedule_poll = partial(reactor.callLater, offload_poll_wait, send_poll)
-
     logger.debug("Attempting to farm out vector calculation")
-    df = _network_handler.node.sendOffloadCommand(struct)
+    df = node.sendOffloadCommand(struct)
     df.addCallback(got_response)
 
     return outer_df
 
+def _plugin_vector_key(plugin_key, content_digest, variant=''):
+    return _network_handler.hash_function(
+            "plugin_vector_" + plugin_key + content_digest + variant)
+
+def get_plugin_vectors_by_digest(plugins, content_digest):
+    """ Returns a deferred, which will be called back with a dict of
+    plugin_key => vector, holding every vector previously calculated by one
+    of the provided plugins for audio with the provided content digest, with
+    the plugin's current settings (see Plugin.vector_variant).
+
+    Each vector is looked for on this node first, then on the network.
+    """
+    vectors = {}
+
+    def got_value(value, plugin_key):
+        if value is None:
+            return
+        try:
+            h = codec.decode(value)
+        except codec.DecodeError, e:
+            logger.warn("Could not decode vector: %s", e)
+            return
+        if h.get('type') == 'plugin_vector':
+            vectors[plugin_key] = h['vector']
+
+    def failed(failure):
+        logger.debug("Vector lookup failed: %s", failure.getErrorMessage())
+        return None
+
+    def done(val):
+        logger.debug("Found %d of %d vectors for content %s",
+                len(vectors), len(plugins), content_digest)
+        return vectors
+
+    dfs = []
+    for plugin in plugins:
+        key = _plugin_vector_key(plugin.get_key(), content_digest,
+                plugin.vector_variant())
+        df = _network_handler.get_value(key)
+        df.addErrback(failed)
+        df.addCallback(got_value, plugin.get_key())
+        dfs.append(df)
+
+    list_df = defer.DeferredList(dfs)
+    list_df.addCallback(done)
+    return list_df
+
+def store_plugin_vectors_by_digest(content_digest, vectors, plugins=()):
+    """ Store each vector in the dict plugin_key => vector, so that
+    get_plugin_vectors_by_digest can find it. The vectors are stored under
+    the variant of the matching Plugin in plugins, if any.
+
+    Empty or zeroed vectors are an indication that Marsyas choked, and are
+    not stored.
+    """
+    variants = dict([(p.get_key(), p.vector_variant()) for p in plugins])
+    dfs = []
+    for plugin_key in vectors:
+        vector = vectors[plugin_key]
+        if not vector or not [a for a in vector if a != 0]:
+            continue
+
+        my_string = codec.encode({
+            'vector': vector,
+            'plugin_key': plugin_key,
+            'content_digest': content_digest,
+            'type': 'plugin_vector'
+        })
+        key = _plugin_vector_key(plugin_key, content_digest,
+                variants.get(plugin_key, ''))
+        df = _network_handler.dht_store_value(key, my_string)
+        dfs.append(df)
+
+    list_df = defer.DeferredList(dfs)
+    return list_df
+
 def initialize_storage(callback):
     """ Initializes an empty storage environment.
 
@@ -816,82 +1366,289 @@ def initialize_storage(callback):
     """
     pass
 
+def _update_tag_stats(tag, audio_files, sign):
+    """ Add (sign=1) or subtract (sign=-1) the vectors of audio_files
+    to/from tag.vector_sum, and adjust tag.count to match.
+
+    Files whose vector is missing, empty, not a flat list of numbers, or
+    a different length from the tag's, are left out and not counted. If
+    the tag's statistics are unknown, the changes are kept aside until it
+    is saved.
+    """
+    if tag.count is None:
+        count, total = tag._pending_count, tag._pending_sum
+    else:
+        count, total = tag.count, tag.vector_sum
+    if total:
+        total = array(total, dtype=float)
+    else:
+        total = None
+
+    for audio_file in audio_files:
+        try:
+            vector = array(audio_file.vector, dtype=float)
+        except (TypeError, ValueError):
+            vector = None
+        if vector is None or vector.ndim != 1 or not len(vector) or \
+                (total is not None and vector.shape != total.shape):
+            logger.debug("Not counting %r towards %r", audio_file, tag)
+            continue
+        if total is None:
+            total = zeros(len(vector))
+        total += sign * vector
+        count += sign
+
+    if total is not None:
+        total = total.tolist()
+    if tag.count is None:
+        tag._pending_count, tag._pending_sum = count, total
+    else:
+        tag.count, tag.vector_sum = count, total
+
+def _unique_pairs(pairs):
+    """ Return pairs of (audio_file, tag) with duplicates removed, comparing
+    by key. The first object seen for each key is used throughout, so that
+    tag statistics are accumulated on a single Tag.
+    """
+    files = {}
+    tags = {}
+    seen = Set()
+    unique = []
+    for audio_file, tag in pairs:
+        audio_file = files.setdefault(audio_file.get_key(), audio_file)
+        tag = tags.setdefault(tag.get_key(), tag)
+        key = (audio_file.get_key(), tag.get_key())
+        if key not in seen:
+            seen.add(key)
+            unique.append((audio_file, tag))
+    return unique
+
 def apply_tag_to_file(audio_file, tag):
+    """ Apply tag to audio_file, and add the file vector to the tag's
+    running statistics.
+
+    Does nothing if the tag has already been applied to the file.
+    """
     logger.info("APPLYING TAG TO FILE: %r %r", tag, audio_file)
+    return apply_tags([(audio_file, tag)])
+
+def apply_tags(pairs, check_existing=True):
+    """ Apply tags to files, for every (audio_file, tag) pair in pairs, and
+    update the running statistics of each tag.
+
+    Duplicate pairs are ignored, as are pairs where the tag has already
+    been applied to the file. If check_existing is False, the caller
+    promises that none of the files has its tag yet (eg, the files are
+    brand new), and the lookups for existing tuples are skipped.
+
+    Lookups and writes are made at most write_limit at a time.
+
+    Immediately returns a deferred that will return the number of pairs
+    applied, once all of the tuples and tags have been written.
+    """
+    pairs = _unique_pairs(pairs)
+    new_pairs = []
+    logger.info("APPLYING %d TAG/FILE PAIRS", len(pairs))
+
+    def got_existing(existing, pair):
+        if not existing:
+            new_pairs.append(pair)
+
+    def find_new_pairs():
+        if not check_existing:
+            new_pairs.extend(pairs)
+            return defer.succeed(None)
+
+        sem = defer.DeferredSemaphore(_network_handler.write_limit)
+        dfs = []
+        for audio_file, tag in pairs:
+            audio_tuple = ("audio_file", audio_file.get_key(), "tag", tag.get_key())
+            df = sem.run(_network_handler.dht_get_tuples, audio_tuple)
+            df.addCallback(got_existing, (audio_file, tag))
+            dfs.append(df)
+        return defer.DeferredList(dfs)
+
+    def save_tuples(val):
+        tuples = []
+        for audio_file, tag in new_pairs:
+            tuples.append(("tag", tag.get_key(), "audio_file", audio_file.get_key()))
+            tuples.append(("audio_file", audio_file.get_key(), "tag", tag.get_key()))
+
+        df = _network_handler.dht_store_tuples(tuples)
+        return df
+
+    def save_tags(val):
+        tagged = {}
+        for audio_file, tag in new_pairs:
+            tagged.setdefault(tag.get_key(), (tag, []))[1].append(audio_file)
+
+        dfs = []
+        for tag, audio_files in tagged.values():
+            _update_tag_stats(tag, audio_files, 1)
+            dfs.append(tag.save())
+        return defer.DeferredList(dfs)
+
+    def done(val):
+        return len(new_pairs)
+
+    df = find_new_pairs()
+    df.addCallback(save_tuples)
+    df.addCallback(save_tags)
+    df.addCallback(done)
+    return df
+
+def apply_tags_to_files(audio_files, tags, check_existing=True):
+    """ Apply every tag in tags to every file in audio_files. See apply_tags.
+    """
+    pairs = [(f, t) for f in audio_files for t in tags]
+    return apply_tags(pairs, check_existing)
+
+def remove_tag_from_file(audio_file, tag):
+    """ Remove tag from audio_file, and subtract the file vector from the
+    tag's running statistics.
+
+    Does nothing if the tag was never applied to the file.
+    """
+    logger.info("REMOVING TAG FROM FILE: %r %r", tag, audio_file)
 
     tag_tuple = ("tag", tag.get_key(), "audio_file", audio_file.get_key())
     audio_tuple = ("audio_file", audio_file.get_key(), "tag", tag.get_key())
 
-    def save_tag_tuple(val):
-        tag_df = _network_handler.dht_store_tuple(tag_tuple)
-        return tag_df
+    def remove_tuples(val):
+        tag_df = _network_handler.dht_remove_tuples(tag_tuple)
+        audio_df = _network_handler.dht_remove_tuples(audio_tuple)
+        return defer.DeferredList([tag_df, audio_df])
 
-    def save_audio_tuple(val):
-        audio_df = _network_handler.dht_store_tuple(audio_tuple)
-        return audio_df
+    def save_tag(val):
+        _update_tag_stats(tag, [audio_file], -1)
+        return tag.save()
 
-    # chain our tuple saving procedures, so they don't happen at the same time
-    df = defer.Deferred()
-    df.addCallback(save_tag_tuple)
-    df.addCallback(save_audio_tuple)
-    df.callback(None)
+    def got_existing(existing):
+        if not existing:
+            logger.debug("%r is not applied to %r", tag, audio_file)
+            return None
+
+        df = defer.Deferred()
+        df.addCallback(remove_tuples)
+        df.addCallback(save_tag)
+        df.callback(None)
+        return df
+
+    df = _network_handler.dht_get_tuples(audio_tuple)
+    df.addCallback(got_existing)
     return df
 
-def remove_guessed_tags():
-    outer_df = defer.Deferred()
-    logger.debug("_")
+def replace_file_vector(audio_file, old_vector):
+    """ Move audio_file's contribution to the running statistics of every
+    tag applied to it from old_vector to its current vector, after the
+    file's vector has been regenerated.
 
-    def done(val):
-        logger.debug("remove_guessed_tags")
-        outer_df.callback(val)
+    Immediately returns a deferred that will return once the tags have
+    been saved.
+    """
+    new_vector = audio_file.vector
 
-    def remove_tag_tuples(val):
-        logger.debug("remove_guessed_tags")
-        tag_tuple = ("tag", None, "guessed_file", None)
-        df = _network_handler.dht_remove_tuples(tag_tuple)
-        return df
+    def got_tags(tags):
+        dfs = []
+        for tag in tags:
+            if tag.count is None:
+                continue
+            # A missing old vector was never counted, so is left out here.
+            audio_file.vector = old_vector
+            _update_tag_stats(tag, [audio_file], -1)
+            audio_file.vector = new_vector
+            _update_tag_stats(tag, [audio_file], 1)
+            dfs.append(tag.save())
+        return defer.DeferredList(dfs)
+
+    df = get_tags(audio_file=audio_file)
+    df.addCallback(got_tags)
+    return df
 
-    def remove_audio_tuples(val):
-        logger.debug("remove_guessed_tags")
-        audio_tuple = ("audio_file", None, "guessed_tag", None)
-        df = _network_handler.dht_remove_tuples(audio_tuple)
-        return df
+def get_guessed_pairs(audio_files):
+    """ Returns a deferred, which will be called back with a Set of
+    (audio file key, tag key) pairs for every tag guessed for one of
+    audio_files.
+    """
+    keys = Set([f.get_key() for f in audio_files])
+    if len(keys) == 1:
+        template = ("audio_file", list(keys)[0], "guessed_tag", None)
+    else:
+        template = ("audio_file", None, "guessed_tag", None)
 
-    df = defer.Deferred()
-    df.addCallback(remove_tag_tuples)
-    df.addCallback(remove_audio_tuples)
-    df.addCallback(done)
-    df.callback(None)
+    def got_tuples(tuples):
+        return Set([(t[1], t[3]) for t in tuples or [] if t[1] in keys])
 
-    return outer_df
+    df = _network_handler.dht_get_tuples(template)
+    df.addCallback(got_tuples)
+    return df
+
+def remove_guessed_tags():
+    """ Remove every guessed tag from every file.
+
+    Immediately returns a deferred that will return the number of tuples
+    removed.
+    """
+    tag_tuple = ("tag", None, "guessed_file", None)
+    audio_tuple = ("audio_file", None, "guessed_tag", None)
+
+    def done(results):
+        total = sum([value for success, value in results if success])
+        logger.debug("remove_guessed_tags removed %d tuples", total)
+        return total
+
+    tag_df = _network_handler.dht_remove_tuples(tag_tuple)
+    audio_df = _network_handler.dht_remove_tuples(audio_tuple)
+
+    list_df = defer.DeferredList([tag_df, audio_df])
+    list_df.addCallback(done)
+    return list_df
 
 
 
 def guess_tag_for_file(audio_file, tag):
-    outer_df = defer.Deferred()
+    """ Record that tag was guessed for audio_file.
 
-    tag_tuple = ("tag", tag.get_key(), "guessed_file", audio_file.get_key())
-    audio_tuple = ("audio_file", audio_file.get_key(), "guessed_tag", tag.get_key())
+    Immediately returns a deferred that will return once both
+    cross-reference tuples have been written.
+    """
+    return guess_tags_for_files([(audio_file, tag)])
 
-    def save_tag_tuple(val):
-       df = _network_handler.dht_store_tuple(tag_tuple)
-       return df
+def guess_tags_for_files(pairs):
+    """ Record a guessed tag for every (audio_file, tag) pair in pairs.
+    Duplicate pairs are ignored, and the tuples are written at most
+    write_limit at a time.
 
-    def save_audio_tuple(val):
-        df = _network_handler.dht_store_tuple(audio_tuple)
-        return df
+    Immediately returns a deferred that will return the number of pairs
+    written.
+    """
+    pairs = _unique_pairs(pairs)
+    logger.debug("Guessing %d tag/file pairs", len(pairs))
 
-    def done(val):
-        outer_df.callback(val)
+    tuples = []
+    for audio_file, tag in pairs:
+        tuples.append(("audio_file", audio_file.get_key(), "guessed_tag", tag.get_key()))
+        tuples.append(("tag", tag.get_key(), "guessed_file", audio_file.get_key()))
 
-    # chain our tuple saving procedures, so they don't happen at the same time
-    df = defer.Deferred()
-    df.addCallback(save_audio_tuple)
-    df.addCallback(save_tag_tuple)
-    df.addCallback(done)
-    df.callback(None)
+    df = _network_handler.dht_store_tuples(tuples)
+    df.addCallback(lambda val: len(pairs))
+    return df
 
-    return outer_df
+
+def remove_guessed_tag_for_file(audio_file, tag):
+    """ Remove a single guessed tag from a single file.
+
+    Immediately returns a deferred that will return once both
+    cross-reference tuples have been removed.
+    """
+    tag_tuple = ("tag", tag.get_key(), "guessed_file", audio_file.get_key())
+    audio_tuple = ("audio_file", audio_file.get_key(), "guessed_tag", tag.get_key())
+
+    tag_df = _network_handler.dht_remove_tuples(tag_tuple)
+    audio_df = _network_handler.dht_remove_tuples(audio_tuple)
+
+    list_df = defer.DeferredList([tag_df, audio_df])
+    return list_df
 
 
 # this only runs if the module was *not* imported
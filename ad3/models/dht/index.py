@@ -0,0 +1,267 @@
+"""
+A node-local index over the tuples in the tuple space.
+
+Every tuple this node puts, or reads back from the network, is indexed
+under (tuple type, field position, value) for each of its fields, so that
+template reads like ("audio_file", None, "tag", key) become a few set
+intersections instead of a network operation.
+
+The index only knows about other nodes' tuples from what it has read, so
+it is only trusted to answer a template once it has seen the complete
+network result for that template (or for a more general one: a template
+with a subset of its constraints) within the last C{ttl} seconds. Those
+are the authoritative partitions. Tuples this node puts or removes in the
+meantime are applied to the index, so they stay correct. A network read
+is timed from when it was issued (see begin_read), and its result doesn't
+undo tuples this node put or removed while it was in flight.
+
+Tuples only matter while an authoritative template covers them, so every
+C{prune_interval} seconds, or whenever the index holds more than
+C{max_tuples}, expired templates and the tuples no remaining template
+covers are dropped.
+"""
+from time import time
+from sets import Set
+
+import logging
+logger = logging.getLogger('3ad')
+
+
+def _constraints(template):
+    """ Return the (position, value) pairs a template constrains. """
+    return [(i, v) for i, v in enumerate(template) if v is not None]
+
+def _matches(template, dTuple):
+    if len(template) != len(dTuple):
+        return False
+    for i, v in _constraints(template):
+        if dTuple[i] != v:
+            return False
+    return True
+
+def _generalizations(template):
+    """ Yield template, and every template matching a superset of what it
+    matches: the same length, with some of its constraints left out.
+    """
+    constraints = _constraints(template)
+    for mask in range(1 << len(constraints)):
+        general = [None] * len(template)
+        for bit, (i, v) in enumerate(constraints):
+            if not mask & (1 << bit):
+                general[i] = v
+        yield tuple(general)
+
+
+class TupleIndex(object):
+    """
+    Attributes:
+        ttl             seconds a complete network read keeps its template
+                        authoritative
+        max_tuples      tuples to hold before pruning early (None: no limit)
+        prune_interval  seconds between prunes
+        hits            template reads answered locally
+        misses          template reads that had to go to the network
+        pruned          tuples dropped by pruning so far
+    """
+    def __init__(self, ttl=30, max_tuples=100000, prune_interval=60):
+        self.ttl = ttl
+        self.max_tuples = max_tuples
+        self.prune_interval = prune_interval
+        self.hits = 0
+        self.misses = 0
+        self.pruned = 0
+        self._last_prune = time()
+
+        self._tuples = Set()
+        self._index = {}            # (type, position, value) -> Set of tuples
+        self._authoritative = {}    # template -> expiry
+
+        # Local puts and removes are numbered, and while any network read
+        # is in flight, the number of the last change to each tuple is kept.
+        self._generation = 0
+        self._reads = 0
+        self._changes = {}          # tuple -> generation of its last change
+
+    def __repr__(self):
+        return "<TupleIndex(tuples=%d, partitions=%d)>" % (
+                len(self._tuples), len(self._authoritative))
+
+    def __len__(self):
+        return len(self._tuples)
+
+    def add(self, dTuple):
+        """ Index a tuple this node has put. """
+        self._changed(dTuple)
+        self._add(dTuple)
+        self._maybe_prune()
+
+    def _changed(self, dTuple):
+        self._generation += 1
+        if self._reads:
+            self._changes[tuple(dTuple)] = self._generation
+
+    def _add(self, dTuple):
+        dTuple = tuple(dTuple)
+        if dTuple in self._tuples:
+            return
+        self._tuples.add(dTuple)
+        for i, v in enumerate(dTuple):
+            self._index.setdefault((dTuple[0], i, v), Set()).add(dTuple)
+
+    def remove(self, dTuple):
+        """ Unindex a tuple this node has removed. """
+        self._changed(dTuple)
+        self._remove(dTuple)
+
+    def _remove(self, dTuple):
+        dTuple = tuple(dTuple)
+        if dTuple not in self._tuples:
+            return
+        self._tuples.remove(dTuple)
+        for i, v in enumerate(dTuple):
+            entry = (dTuple[0], i, v)
+            partition = self._index.get(entry)
+            if partition is not None:
+                partition.discard(dTuple)
+                if not partition:
+                    del self._index[entry]
+
+    def remove_matching(self, template):
+        for dTuple in self.matching(template):
+            self.remove(dTuple)
+
+    def begin_read(self):
+        """ Note that a network read is about to be issued. Returns a token
+        to hand to learn() with its result, or to end_read() if it fails.
+        """
+        self._reads += 1
+        return (self._generation, time())
+
+    def end_read(self, token):
+        """ Note that the read begun with token is over. """
+        self._reads -= 1
+        if not self._reads:
+            self._changes.clear()
+
+    def learn(self, template, tuples, token=None):
+        """ Record tuples as the complete network result for template,
+        making it authoritative for ttl seconds from when the read began.
+
+        With the token from begin_read, tuples put or removed locally since
+        the read was issued are left as they are.
+        """
+        template = tuple(template)
+        if token is None:
+            generation, started = self._generation, time()
+        else:
+            generation, started = token
+
+        def changed(dTuple):
+            return self._changes.get(dTuple, 0) > generation
+
+        found = Set()
+        for dTuple in tuples or []:
+            dTuple = tuple(dTuple)
+            found.add(dTuple)
+            if not changed(dTuple):
+                self._add(dTuple)
+
+        # Anything we knew of that the network no longer has is gone.
+        for dTuple in self.matching(template):
+            if dTuple not in found and not changed(dTuple):
+                self._remove(dTuple)
+
+        self._authoritative[template] = started + self.ttl
+        if token is not None:
+            self.end_read(token)
+        self._maybe_prune()
+
+    def forget(self, template=None):
+        """ Stop trusting the index for template, or for everything. """
+        if template is None:
+            self._authoritative.clear()
+        else:
+            self._authoritative.pop(tuple(template), None)
+
+    def prune(self):
+        """ Drop expired templates, and every tuple that none of the
+        remaining ones covers. If that still leaves more than max_tuples,
+        start again from an empty index.
+        """
+        now = time()
+        self._last_prune = now
+        for template, expiry in self._authoritative.items():
+            if now >= expiry:
+                del self._authoritative[template]
+
+        keep = Set()
+        for template in self._authoritative:
+            keep.update(self.matching(template))
+        for dTuple in list(self._tuples):
+            if dTuple not in keep:
+                self._remove(dTuple)
+                self.pruned += 1
+
+        if self.max_tuples is not None and len(self._tuples) > self.max_tuples:
+            logger.debug("Tuple index still holds %d tuples; clearing it", len(self._tuples))
+            self.pruned += len(self._tuples)
+            self.clear()
+
+    def clear(self):
+        self._tuples.clear()
+        self._index.clear()
+        self._authoritative.clear()
+
+    def _maybe_prune(self):
+        if self.max_tuples is not None and len(self._tuples) > self.max_tuples:
+            self.prune()
+        elif time() - self._last_prune >= self.prune_interval:
+            self.prune()
+
+    def is_authoritative(self, template):
+        now = time()
+        for general in _generalizations(tuple(template)):
+            expiry = self._authoritative.get(general)
+            if expiry is None:
+                continue
+            if now < expiry:
+                return True
+            del self._authoritative[general]
+        return False
+
+    def matching(self, template):
+        """ Return a list of the indexed tuples matching template. """
+        template = tuple(template)
+        if not template or template[0] is None:
+            candidates = self._tuples
+        else:
+            partitions = [self._index.get((template[0], i, v), Set())
+                    for i, v in _constraints(template)]
+            partitions.sort(key=len)
+            candidates = partitions[0]
+            for partition in partitions[1:]:
+                if not candidates:
+                    break
+                candidates = candidates.intersection(partition)
+
+        return [t for t in candidates if _matches(template, t)]
+
+    def read(self, template):
+        """ Return a list of the tuples matching template if the index is
+        authoritative for it, or None if the network must be asked.
+        """
+        if self.is_authoritative(template):
+            self.hits += 1
+            return self.matching(template)
+        self.misses += 1
+        return None
+
+    def stats(self):
+        return dict(
+            tuples = len(self._tuples),
+            partitions = len(self._index),
+            authoritative = len(self._authoritative),
+            hits = self.hits,
+            misses = self.misses,
+            pruned = self.pruned,
+        )
@@ -1,32 +1,69 @@
 # system
 import os
 import random
+import time
 from functools import partial
 import cPickle
 # entangled
 import entangled
 import entangled.dtuple
 from entangled.kademlia.node import rpcmethod
+from entangled.kademlia import constants
 # twisted
 from twisted.internet.reactor import listenTCP
 from twisted.internet import defer
 from twisted.internet import reactor
+from twisted.internet import task
 # 3ad
 import protocol
+from cache import ValueCache, value_size
+from sets import Set
 import logging
 logger = logging.getLogger('3ad')
 
+def _distance(keyOne, keyTwo):
+    """ The XOR distance between two keys, as Kademlia measures it. """
+    return long(keyOne.encode('hex'), 16) ^ long(keyTwo.encode('hex'), 16)
+
+
 class Node(entangled.dtuple.DistributedTupleSpacePeer):
     def __init__(self, id=None, udpPort=4000, tcpPort=4000,
                  dataStore=None, routingTable=None,
-                 networkProtocol=None):
+                 networkProtocol=None, cacheBytes=32*1024*1024,
+                 flushInterval=5.0, flushBytes=1024*1024,
+                 storeConcurrency=8, storeBatchSize=64,
+                 offloadParallel=3, offloadDeadline=30, reservationTimeout=30,
+                 offloadSlots=1, offloadQueue=2, downloadTimeout=300):
 
         self.tcpPort = tcpPort
         self._oobListeningPort = None
         self._oobServerFactory = None
         self.computations = {}
 
-        self.cachedValues = {}
+        # Offloading asks up to offloadParallel contacts at once, and gives
+        # up after offloadDeadline seconds. A reservation this node has
+        # granted lapses if it isn't committed within reservationTimeout.
+        self.offloadParallel = offloadParallel
+        self.offloadDeadline = offloadDeadline
+        self.reservationTimeout = reservationTimeout
+        self._reservations = {}     # file_key -> (requester id, file_uri, timer, queued)
+
+        # This node runs up to offloadSlots computations for other nodes at
+        # once. When they're all taken, up to offloadQueue more requests are
+        # admitted, and wait for a slot.
+        self.offloadSlots = offloadSlots
+        self.offloadQueue = offloadQueue
+        self._running = Set()       # file_keys being computed
+        self._admitted = []         # committed (file_key, file_uri, contact, queued) waiting for a slot
+        # Seconds an offloaded file may take to download (0: no limit)
+        self.downloadTimeout = downloadTimeout
+        self._peerSlots = {}        # contact id -> free slots it last advertised
+        self._offloadWaiters = {}   # file_key -> (worker id, deferred)
+
+        # Values we've fetched or written, kept under cacheBytes. Writes
+        # that haven't been flushed yet are also held in markedValues, so
+        # evicting them from here loses nothing.
+        self.cachedValues = ValueCache(cacheBytes)
         self.markedValues = {}
 
         self.timesCacheFetched = 0
@@ -34,6 +71,23 @@ class Node(entangled.dtuple.DistributedTupleSpacePeer):
         self.timesMarked = 0
         self.bytesMarked = 0
 
+        # Buffered writes are flushed every flushInterval seconds, as soon
+        # as flushBytes are waiting, and on shutdown. Each store RPC carries
+        # up to storeBatchSize values, with at most storeConcurrency of
+        # them in flight.
+        self.flushInterval = flushInterval
+        self.flushBytes = flushBytes
+        self.storeConcurrency = storeConcurrency
+        self.storeBatchSize = storeBatchSize
+        self.bytesPending = 0
+        self.flushStats = {}
+        self.timesFlushed = 0
+        self._markedSince = None
+        self._flushing = None
+        self._flushWaiters = []
+        self._flushLoop = None
+        self._shutdownTrigger = None
+
         entangled.dtuple.DistributedTupleSpacePeer.__init__(
             self, id=id, udpPort=udpPort, dataStore=dataStore,
             routingTable=routingTable, networkProtocol=networkProtocol
@@ -48,102 +102,405 @@ class Node(entangled.dtuple.DistributedTupleSpacePeer):
         self._oobListeningPort = \
             listenTCP(self.tcpPort, self._oobServerFactory)
 
-    def sendOffloadCommand(self, struct):
+        if self.flushInterval and self._flushLoop is None:
+            self._flushLoop = task.LoopingCall(self._timedFlush)
+            self._flushLoop.start(self.flushInterval, now=False)
+            self._shutdownTrigger = reactor.addSystemEventTrigger(
+                    'before', 'shutdown', self._shutdownFlush)
+
+    def leaveNetwork(self):
+        """ Flush any buffered writes, then stop listening on this node's
+        UDP and TCP ports, so that another node can use them.
+
+        Immediately returns a deferred that will return once the ports have
+        been closed.
+        """
+        def stop(val):
+            ports = [self._oobListeningPort, getattr(self, '_listeningPort', None)]
+            self._oobListeningPort = None
+            self._listeningPort = None
+            dfs = [defer.maybeDeferred(port.stopListening)
+                    for port in ports if port is not None]
+            return defer.DeferredList(dfs)
+
+        if self._shutdownTrigger is not None:
+            reactor.removeSystemEventTrigger(self._shutdownTrigger)
+            self._shutdownTrigger = None
+
+        df = self._shutdownFlush()
+        self._flushLoop = None
+        df.addErrback(lambda failure: logger.error(
+                "Flushing writes failed: %s", failure.getTraceback()))
+        df.addCallback(stop)
+        return df
+
+    def sendOffloadCommand(self, struct, parallel=None, deadline=None):
         """ Will set up oobServerFactory to accept download requests for
         the file described in C{struct} and issue the offload command
         to the nearest available contact.
 
         Will query at most protocol.k contacts, as per the method
-        C{self.iterativeFindNode}.
+        C{self.iterativeFindNode}, asking up to C{parallel} of them at once
+        (by default, self.offloadParallel) to reserve themselves. Contacts
+        that last advertised free slots are asked first. The first to
+        accept with a free slot is told to go ahead, and any other
+        reservations are cancelled. A contact that could only queue the
+        request is held on to, and told to go ahead if nobody with a free
+        slot turns up. Gives up after C{deadline} seconds (by default,
+        self.offloadDeadline), although a go-ahead already sent is waited
+        for.
 
-        Immediately returns a deferred that will return either C{True} or
-        C{False} depending on whether the command was accepted by a remote
-        node.
+        Immediately returns a deferred that will return either "OK" or
+        "NO" depending on whether the command was accepted by a remote
+        node. If it was, struct['contact'] is the node that accepted.
         """
+        if parallel is None:
+            parallel = self.offloadParallel
+        if deadline is None:
+            deadline = self.offloadDeadline
+
+        file_key = struct['file_key']
         contacts = []
         outer_df = defer.Deferred()
+        state = {'asking': 0, 'committing': False, 'found': False,
+                 'expired': False, 'held': None}
+        timer = []
 
-        def executeRPC():
-            contact = contacts.pop(0)
-            logger.debug("SENDING RPC TO: %r; %d contacts left",
-                    contact, len(contacts))
-            struct['contact'] = contact
+        def finish(response):
+            if outer_df.called:
+                return
+            if timer and timer[0].active():
+                timer[0].cancel()
 
-            # Tell our server factory to accept this request.
-            self._oobServerFactory.add_request_key(
-                    struct['file_key'], struct['file_uri'])
+            if state['held'] is not None:
+                cancel(state['held'])
+                state['held'] = None
+
+            if response != "OK":
+                # If the file was downloaded, the request will have been
+                # automatically removed from the server's ACL thing. But lets
+                # make sure:
+                self._oobServerFactory.get_request_key(file_key)
+
+            # We're done. Trigger the outer deferred.
+            outer_df.callback(response)
+
+        def cancel(contact):
+            logger.debug("Cancelling redundant reservation on %r", contact)
+            df = contact.cancelOffload(file_key)
+            df.addErrback(lambda failure: None)
+
+        def askNext():
+            while contacts and state['asking'] < parallel and \
+                    not state['expired'] and not state['found']:
+                contact = contacts.pop(0)
+                state['asking'] += 1
+                logger.debug("SENDING RPC TO: %r; %d contacts left",
+                        contact, len(contacts))
+                df = contact.reserveOffload(file_key, struct['file_uri'])
+                df.addBoth(gotReservation, contact)
+
+            if state['asking'] == 0 and not state['committing']:
+                if state['held'] is not None:
+                    commitHeld()
+                else:
+                    finish("NO")
 
-            # Ask the contact to do it.
-            rpc_df = contact.offload(
-                    struct['file_key'], struct['file_uri'])
+        def commit(contact):
+            state['committing'] = True
+            df = contact.commitOffload(file_key)
+            df.addBoth(gotCommit, contact)
 
-            rpc_df.addBoth(receiveResponse)
+        def commitHeld():
+            # Nobody had a free slot; settle for a place in a queue.
+            contact = state['held']
+            state['held'] = None
+            logger.debug("Settling for a queued offload on %r", contact)
+            commit(contact)
 
-            return rpc_df
+        def gotReservation(response, contact):
+            state['asking'] -= 1
+            status, free, queued = self._parseOffloadReply(response, contact)
+            if status != "OK":
+                askNext()
+                return None
 
-        def receiveResponse(response):
-            if len(contacts) > 0 and response != "OK":
-                # If the request wasn't accepted, but we still have more
-                # contacts to try, do so.
-                executeRPC()
+            if state['found'] or state['committing'] or state['expired']:
+                cancel(contact)
+                return None
+
+            if queued:
+                if state['held'] is None:
+                    state['held'] = contact
+                else:
+                    cancel(contact)
+                askNext()
+                return None
+
+            if state['held'] is not None:
+                cancel(state['held'])
+                state['held'] = None
+
+            # Tell the contact to go ahead.
+            commit(contact)
+            return None
+
+        def gotCommit(response, contact):
+            state['committing'] = False
+            if response == "OK":
+                state['found'] = True
+                struct['contact'] = contact
+                finish("OK")
+            elif state['expired']:
+                finish("NO")
             else:
-                # If the file was downloaded, the request will have been
-                # automatically removed from the server's ACL thing. But lets
-                # make sure:
-                if response != "OK":
-                    try: self._oobServerFactory.get_request_key(struct['file_key'])
-                    except KeyError, e: pass
+                logger.debug("%r didn't go ahead: %r", contact, response)
+                askNext()
 
-                # We're done. Trigger the outer deferred.
-                outer_df.callback(response)
+        def expire():
+            logger.debug("Offload negotiation for %r timed out", struct['file_name'])
+            state['expired'] = True
+            if state['committing']:
+                return
+            if state['held'] is not None:
+                commitHeld()
+            else:
+                finish("NO")
 
         def gotNodes(nodes):
+            # Ask the nodes we know to have free slots first; nodes we
+            # haven't heard from probably have one.
             contacts.extend(nodes)
-            receiveResponse('begin')
+            contacts.sort(key=lambda c: -self._peerSlots.get(c.id, 1))
+
+            # Tell our server factory to accept this request.
+            self._oobServerFactory.add_request_key(file_key, struct['file_uri'])
+
+            if deadline:
+                timer.append(reactor.callLater(deadline, expire))
+            askNext()
+
+        def failed(failure):
+            logger.debug("Couldn't find nodes to offload to: %s", failure.getErrorMessage())
+            outer_df.callback("NO")
 
         # Find k nodes closest to the key...
-        inner_df = self.iterativeFindNode(struct['file_key'])
-        inner_df.addCallback(gotNodes)
+        inner_df = self.iterativeFindNode(file_key)
+        inner_df.addCallbacks(gotNodes, failed)
 
         return outer_df
 
+    def _parseOffloadReply(self, response, contact):
+        """ Return (status, free slots, queued) from a reserveOffload reply,
+        which older nodes send as just "OK" or "NO", and remember how many
+        free slots contact advertised.
+        """
+        if isinstance(response, dict):
+            status = response.get('status')
+            free = response.get('free', 0)
+            queued = response.get('queued', False)
+        elif response == "OK":
+            status, free, queued = "OK", 0, False
+        else:
+            # A refusal, or a failure
+            status, free, queued = "NO", 0, False
+
+        if isinstance(response, dict) or response == "NO":
+            self._peerSlots[contact.id] = free
+        return status, free, queued
+
     def pollOffloadedCalculation(self, struct):
         df = struct['contact'].poll(struct['file_key'])
         return df
 
+    def waitForOffloadedCalculation(self, struct):
+        """ Wait for the contact in struct['contact'] to report back with
+        offloadComplete.
+
+        Immediately returns a deferred that will return the same dict a
+        poll() would, once the result arrives. It never fires if the
+        contact doesn't report back; see stopWaitingForOffload.
+        """
+        self.stopWaitingForOffload(struct['file_key'])
+        df = defer.Deferred()
+        self._offloadWaiters[struct['file_key']] = (struct['contact'].id, df)
+        return df
+
+    def stopWaitingForOffload(self, file_key):
+        self._offloadWaiters.pop(file_key, None)
+
     @rpcmethod
-    def offload(self, file_key, file_uri,
+    def offloadComplete(self, file_key, result,
             _rpcNodeID, _rpcNodeContact, **kwargs):
-        """ RPC method to request that this node performs a vector computation
-        for the requesting node.
+        """ RPC method for a node we offloaded a computation to to hand back
+        the result, as soon as it is done. C{result} is the dict poll()
+        would have returned.
+        """
+        waiter = self._offloadWaiters.get(file_key)
+        if waiter is None or waiter[0] != _rpcNodeID:
+            logger.debug("Unexpected offload result from %r", _rpcNodeContact)
+            return "NO"
 
-        If the request is accepted, this method will continue by downloading
-        the file in question from the remote node, collecting all plugins,
-        creating plugin outputs for the plugin, file_key pair, and updating
-        self.computations[file_key] with the resulting vector from the learning
-        module.
+        logger.debug("Offload result pushed by %r", _rpcNodeContact)
+        del self._offloadWaiters[file_key]
+        waiter[1].callback(result)
+        return "OK"
 
-        At each stage, self.computations[file_key] will be updated, so that this
-        node is able to respond to poll() requests.
+    def freeOffloadSlots(self):
+        """ Number of computations this node could start right now. """
+        reserved = [r for r in self._reservations.values() if not r[3]]
+        return max(0, self.offloadSlots - len(self._running) - len(reserved))
+
+    def _queuedOffloads(self):
+        queued = [r for r in self._reservations.values() if r[3]]
+        return len(queued) + len([a for a in self._admitted if a[3]])
+
+    def _offloadReply(self, status, queued=False):
+        return {'status': status, 'free': self.freeOffloadSlots(), 'queued': queued}
+
+    @rpcmethod
+    def reserveOffload(self, file_key, file_uri,
+            _rpcNodeID, _rpcNodeContact, **kwargs):
+        """ RPC method to reserve this node for a vector computation for the
+        requesting node, without starting it.
+
+        If every slot is taken, the request may instead be admitted to the
+        queue, and will run once a slot frees up.
+
+        Returns a dict of
+            status  "OK" if the reservation was granted, or "NO" if this
+                    node is busy
+            free    the number of free slots left on this node
+            queued  True if the request will have to wait for a slot
+
+        The requester must follow up with commitOffload to start the
+        computation, or cancelOffload to release it; otherwise the
+        reservation lapses after self.reservationTimeout seconds.
         """
-        logger.debug("Received an offload RPC - %r; %r",
+        logger.debug("Received a reserveOffload RPC - %r; %r",
                 file_uri, _rpcNodeContact)
 
-        active_computations = [self.computations[c] for c in self.computations if not self.computations[c]['complete']]
+        if file_key in self._reservations or file_key in self._running:
+            logger.info("DECLINING offload request; already working on it")
+            return self._offloadReply("NO")
 
-        if len(active_computations) > 0:
+        if self.freeOffloadSlots() > 0:
+            queued = False
+        elif self._queuedOffloads() < self.offloadQueue:
+            queued = True
+        else:
             logger.info("DECLINING offload request")
-            # If we are already processing something, decline this request
-            return "NO"
+            # If every slot and queue place is taken, decline this request
+            return self._offloadReply("NO")
 
-        logger.info("ACCEPTING offload request")
+        logger.info("RESERVING for offload request%s", queued and " (queued)" or "")
         self.computations[file_key] = {
             'complete': False,
             'vectors': None,
             'failed': False,
             'downloaded': False
         }
+        timer = reactor.callLater(self.reservationTimeout,
+                self._releaseReservation, file_key)
+        self._reservations[file_key] = (_rpcNodeID, file_uri, timer, queued)
+        return self._offloadReply("OK", queued)
+
+    def _releaseReservation(self, file_key):
+        reservation = self._reservations.pop(file_key, None)
+        if reservation is None:
+            return
+        logger.debug("Releasing offload reservation for %r", reservation[1])
+        if reservation[2].active():
+            reservation[2].cancel()
+        del self.computations[file_key]
+        self._admitNext()
+
+    @rpcmethod
+    def commitOffload(self, file_key, _rpcNodeID, _rpcNodeContact, **kwargs):
+        """ RPC method to start a computation reserved with reserveOffload.
+        A queued computation starts as soon as a slot frees up.
+
+        Returns "OK" if the computation has started or been queued, or "NO"
+        if there is no such reservation (eg, it lapsed) for the requesting
+        node.
+        """
+        reservation = self._reservations.get(file_key)
+        if reservation is None or reservation[0] != _rpcNodeID:
+            logger.debug("No reservation to commit for %r", _rpcNodeContact)
+            return "NO"
+
+        requester, file_uri, timer, queued = self._reservations.pop(file_key)
+        if timer.active():
+            timer.cancel()
+
+        logger.info("ACCEPTING offload request")
+        self._admitted.append((file_key, file_uri, _rpcNodeContact, queued))
+        self._admitNext()
+        return "OK"
+
+    @rpcmethod
+    def cancelOffload(self, file_key, _rpcNodeID, _rpcNodeContact, **kwargs):
+        """ RPC method to release a reservation made with reserveOffload. """
+        reservation = self._reservations.get(file_key)
+        if reservation is not None and reservation[0] == _rpcNodeID:
+            self._releaseReservation(file_key)
+        return "OK"
+
+    @rpcmethod
+    def offload(self, file_key, file_uri,
+            _rpcNodeID, _rpcNodeContact, **kwargs):
+        """ RPC method to request that this node performs a vector computation
+        for the requesting node: reserveOffload and commitOffload in one
+        step, for nodes that predate them. Never queues.
+        """
+        logger.debug("Received an offload RPC - %r; %r",
+                file_uri, _rpcNodeContact)
+
+        if self.freeOffloadSlots() == 0:
+            logger.info("DECLINING offload request")
+            return "NO"
+
+        reply = self.reserveOffload(file_key, file_uri, _rpcNodeID, _rpcNodeContact)
+        if reply['status'] != "OK":
+            return "NO"
+        return self.commitOffload(file_key, _rpcNodeID, _rpcNodeContact)
+
+    def _admitNext(self):
+        """ Start waiting computations while there are slots for them.
+        Requests that were granted a slot go first; queued requests only
+        get slots that aren't still promised to an uncommitted reservation.
+        """
+        while self._admitted:
+            promised = [a for a in self._admitted if not a[3]]
+            if promised:
+                entry = promised[0]
+                room = len(self._running) < self.offloadSlots
+            else:
+                entry = self._admitted[0]
+                room = self.freeOffloadSlots() > 0
+            if not room:
+                break
+
+            self._admitted.remove(entry)
+            file_key, file_uri, contact, queued = entry
+            self._running.add(file_key)
+            self._startComputation(file_key, file_uri, contact)
 
+    def _computationFinished(self, val, file_key):
+        self._running.discard(file_key)
+        self._admitNext()
+        return val
+
+    def _startComputation(self, file_key, file_uri, _rpcNodeContact):
+        """ Download the file in question from the remote node, collect all
+        plugins, create plugin outputs for the plugin, file_key pair, and
+        update self.computations[file_key] with the resulting vectors.
+
+        At each stage, self.computations[file_key] will be updated, so that this
+        node is able to respond to poll() requests. Once the computation is
+        done, the result is pushed to the requesting node with its
+        offloadComplete RPC.
+        """
         def got_vectors(results):
             # Everything looks good, so far. Results is a dict of vectors.
             logger.debug("Computed vectors for %s", file_uri)
@@ -169,12 +526,45 @@ class Node(entangled.dtuple.DistributedTupleSpacePeer):
             self.computations[file_key]['failed'] = True
             self.computations[file_key]['complete'] = True
 
+        download = {'done': False, 'timer': None}
+
+        def notify_requester(val):
+            # Hand the result straight back; if this doesn't get through,
+            # the requester will still poll for it.
+            df = _rpcNodeContact.offloadComplete(file_key, self.computations[file_key])
+            df.addErrback(lambda failure: logger.debug(
+                    "Couldn't push offload result to %r: %s",
+                    _rpcNodeContact, failure.getErrorMessage()))
+            return val
+
         def remove_file(val, tmp_file_name):
             # After vectors are calculated (or not) clean up the temp file.
             os.remove(tmp_file_name)
             return val
 
+        def download_failed(reason):
+            if download['done']:
+                return
+            download['done'] = True
+            if download['timer'] is not None and download['timer'].active():
+                download['timer'].cancel()
+
+            logger.warn("Downloading %s from %r failed: %s",
+                    file_uri, _rpcNodeContact, reason)
+            self.computations[file_key]['failed'] = True
+            self.computations[file_key]['complete'] = True
+            notify_requester(None)
+            self._computationFinished(None, file_key)
+
         def downloaded_file(tmp_file_name):
+            if download['done']:
+                # We already gave up on it.
+                os.remove(tmp_file_name)
+                return
+            download['done'] = True
+            if download['timer'] is not None and download['timer'].active():
+                download['timer'].cancel()
+
             logger.info("Finished downloading %s as %r", file_uri, tmp_file_name)
 
             self.computations[file_key]['downloaded'] = True
@@ -183,7 +573,9 @@ class Node(entangled.dtuple.DistributedTupleSpacePeer):
             # Set up our success and failure methods
             df.addCallback(got_vectors)
             df.addErrback(failure)
+            df.addBoth(notify_requester)
             df.addBoth(remove_file, tmp_file_name)
+            df.addBoth(self._computationFinished, file_key)
 
         def download_file():
             # Receive the file in the main loop, but spin processing off
@@ -193,14 +585,16 @@ class Node(entangled.dtuple.DistributedTupleSpacePeer):
                     _rpcNodeContact.port,
                     file_uri)
             clientFactory = protocol.HTTPClientFactory(
-                    downloaded_file, file_key, file_uri, timeout=0)
+                    downloaded_file, file_key, file_uri, timeout=0,
+                    errback=download_failed)
+            if self.downloadTimeout:
+                download['timer'] = reactor.callLater(self.downloadTimeout,
+                        download_failed, "timed out")
             reactor.connectTCP(_rpcNodeContact.address,
                     _rpcNodeContact.port, clientFactory)
 
         download_file()
 
-        return "OK"
-
     @rpcmethod
     def poll(self, file_key, _rpcNodeID, _rpcNodeContact, **kwargs):
         logger.debug("Returning poll")
@@ -226,13 +620,150 @@ class Node(entangled.dtuple.DistributedTupleSpacePeer):
 
         return result
 
+    @rpcmethod
+    def findValues(self, keys, _rpcNodeID, _rpcNodeContact, **kwargs):
+        """ RPC method returning a dict of key => value for each of the
+        requested keys that this node stores.
+
+        Only the data store is consulted: values waiting to be flushed and
+        values cached by our own reads aren't ours to hand out.
+
+        Unlike findValue, this never returns contacts; keys this node
+        doesn't have are simply left out.
+        """
+        logger.debug("Received a findValues RPC for %d keys", len(keys))
+        result = {}
+        for key in keys:
+            if key in self._dataStore:
+                result[key] = self._dataStore[key]
+        return result
+
+    def _localValue(self, key):
+        """ Return the value for key as far as this node knows, including
+        values not yet flushed and values cached by earlier reads, or None.
+        For local reads only.
+        """
+        if key in self._dataStore:
+            return self._dataStore[key]
+        return self._cachedValue(key)
+
+    def _cachedValue(self, key):
+        if key in self.markedValues:
+            return self.markedValues[key][0]
+        return self.cachedValues.get(key)
+
+    def iterativeFindValues(self, keys, timeout=None):
+        """ Find the values for many keys at once.
+
+        Duplicate keys are collapsed, and keys this node already holds are
+        answered locally. The rest are grouped by the closest contact in
+        our routing table, and each group is fetched with a single
+        findValues RPC. Keys a contact doesn't have fall back to a normal
+        iterativeFindValue.
+
+        If timeout (in seconds) is given, gives up waiting after that long.
+
+        Immediately returns a deferred that will return a tuple of
+        (dict of key => value, list of keys that weren't found).
+        """
+        values = {}
+        wanted = []
+        seen = {}
+        for key in keys:
+            if key in seen:
+                continue
+            seen[key] = True
+            wanted.append(key)
+
+            value = self._localValue(key)
+            if value is not None:
+                values[key] = value
+
+        outer_df = defer.Deferred()
+        timer = []
+
+        def finish(val=None):
+            if outer_df.called:
+                return None
+            if timer and timer[0].active():
+                timer[0].cancel()
+            missing = [k for k in wanted if k not in values]
+            logger.debug("iterativeFindValues found %d of %d keys",
+                    len(wanted) - len(missing), len(wanted))
+            outer_df.callback((values, missing))
+            return None
+
+        def got_value(result, key):
+            if isinstance(result, dict) and key in result:
+                values[key] = result[key]
+
+        def find_one(key):
+            df = self.iterativeFindValue(key)
+            df.addCallback(got_value, key)
+            return df
+
+        def got_group(result, group):
+            if isinstance(result, dict):
+                for key in group:
+                    if key in result:
+                        values[key] = result[key]
+                        self.cachedValues[key] = result[key]
+
+            # Do a full lookup for anything the contact didn't have.
+            dfs = [find_one(key) for key in group if key not in values]
+            return defer.DeferredList(dfs, consumeErrors=True)
+
+        def rpc_failed(failure, contact):
+            logger.debug("findValues RPC to %r failed: %s",
+                    contact, failure.getErrorMessage())
+            return None
+
+        groups = {}
+        dfs = []
+        for key in wanted:
+            if key in values:
+                continue
+            contacts = self._routingTable.findCloseNodes(key, 1)
+            if not contacts:
+                dfs.append(find_one(key))
+                continue
+            contact = contacts[0]
+            if contact.id not in groups:
+                groups[contact.id] = (contact, [])
+            groups[contact.id][1].append(key)
+
+        for contact, group in groups.values():
+            logger.debug("Sending findValues for %d keys to %r", len(group), contact)
+            df = contact.findValues(group)
+            df.addErrback(rpc_failed, contact)
+            df.addCallback(got_group, group)
+            dfs.append(df)
+
+        list_df = defer.DeferredList(dfs, consumeErrors=True)
+        list_df.addCallback(finish)
+        if timeout and not outer_df.called:
+            timer.append(reactor.callLater(timeout, finish))
+
+        return outer_df
+
     def iterativeStore(self, key, value, originalPublisherID=None, age=0):
         logger.debug("Caching value and write!")
         self.cachedValues[key] = value
+        if key in self.markedValues:
+            self.bytesPending -= value_size(self.markedValues[key][0])
         self.markedValues[key] = (value, originalPublisherID, age)
 
-#        self.bytesMarked += len(cPickle.dumps(value))
+        size = value_size(value)
+        self.bytesMarked += size
+        self.bytesPending += size
         self.timesMarked += 1
+        if self._markedSince is None:
+            self._markedSince = time.time()
+
+        if self.flushBytes and self.bytesPending >= self.flushBytes \
+                and self._flushing is None:
+            logger.debug("%d bytes waiting to be written; flushing", self.bytesPending)
+            reactor.callLater(0, self._timedFlush)
 
         df = defer.Deferred()
         df.callback(None)
@@ -245,16 +776,23 @@ class Node(entangled.dtuple.DistributedTupleSpacePeer):
               The original kademlia spec incorporates caching.
         """
         def cacheValue(val):
-            logger.debug("Caching value!")
-            self.cachedValues[key] = val
+            # A findValue lookup returns a list of contacts if it didn't
+            # find anything; only cache the value itself.
+            if isinstance(val, dict) and key in val:
+                logger.debug("Caching value!")
+                self.cachedValues[key] = val[key]
             return val
 
-        if rpc == 'findValue' and key in self.cachedValues:
+        value = None
+        if rpc == 'findValue':
+            value = self._cachedValue(key)
+
+        if value is not None:
             logger.debug("Returning cached value!")
             df = defer.Deferred()
-            df.callback({key: self.cachedValues[key]})
+            df.callback({key: value})
 
-#            self.bytesCacheFetched += len(cPickle.dumps(self.cachedValues[key]))
+            self.bytesCacheFetched += value_size(value)
             self.timesCacheFetched += 1
         else:
             logger.debug("No cached value available, or %s != findValue", rpc)
@@ -264,17 +802,234 @@ class Node(entangled.dtuple.DistributedTupleSpacePeer):
                 df.addCallback(cacheValue)
         return df
 
+    @rpcmethod
+    def storeValues(self, values, _rpcNodeID, _rpcNodeContact, **kwargs):
+        """ RPC method storing a batch of values, each a list of
+        (key, value, originalPublisherID, age), in one go.
+        """
+        logger.debug("Received a storeValues RPC for %d values", len(values))
+        for key, value, originalPublisherID, age in values:
+            self.store(key, value, originalPublisherID, age, _rpcNodeID=_rpcNodeID)
+        return 'OK'
+
+    def _timedFlush(self):
+        if self.markedValues and self._flushing is None:
+            df = self.flushWrites()
+            df.addErrback(lambda failure: logger.error(
+                    "Flushing writes failed: %s", failure.getTraceback()))
+
+    def _shutdownFlush(self):
+        if self._flushLoop is not None and self._flushLoop.running:
+            self._flushLoop.stop()
+        return self.flushWrites()
+
     def flushWrites(self):
-        dfs = []
-        for key in self.markedValues.keys():
-            value, originalPublisherID, age = self.markedValues.pop(key)
-            df = entangled.dtuple.DistributedTupleSpacePeer.iterativeStore(
-                self, key, value, originalPublisherID, age)
-            dfs.append(df)
+        """ Write every buffered value to the network.
+
+        Each value goes where iterativeStore would put it: on the k nodes
+        closest to its key, and on this node too if there are fewer than k
+        of them, or it is closer than the furthest. Rather than one lookup
+        per key, keys are grouped by the closest contact in our routing
+        table, and each group shares a single iterativeFindNode. Every key
+        in the group then picks its k closest from the contacts that lookup
+        found, plus those the routing table knows near the key. Values are
+        batched so that each contact gets one storeValues RPC per
+        storeBatchSize values. At most storeConcurrency lookups or RPCs are
+        in flight at once.
+
+        A contact that fails a storeValues RPC is tried once with a plain
+        store, in case it predates storeValues; if that works the rest of
+        its values are stored one by one, otherwise it is given up on.
+        Values that couldn't be stored anywhere stay buffered for the next
+        flush.
+
+        If a flush is already running, this one starts once it's done.
+
+        Immediately returns a deferred that will return a dict reporting
+        how many values, lookups, RPCs and failures there were, how many
+        values were stored locally or kept for later, how long the flush
+        took, and the lag: how long the oldest value waited to be written.
+        """
+        if self._flushing is not None:
+            df = defer.Deferred()
+            self._flushWaiters.append(df)
+            return df
+
+        marked = self.markedValues
+        markedSince = self._markedSince
+        self.markedValues = {}
+        self.bytesPending = 0
+        self._markedSince = None
+
+        start = time.time()
+        stats = dict(values=len(marked), lookups=0, contacts=0, rpcs=0,
+                failed=0, local=0, kept=0)
+        stored = Set()
+
+        # contact id -> (contact, [(key, value, originalPublisherID, age), ...])
+        batches = {}
+        sem = defer.DeferredSemaphore(self.storeConcurrency)
+
+        def item_for(key):
+            value, originalPublisherID, age = marked[key]
+            if originalPublisherID is None:
+                originalPublisherID = self.id
+            return (key, value, originalPublisherID, age)
+
+        def store_locally(item):
+            key, value, originalPublisherID, age = item
+            self.store(key, value, originalPublisherID, age)
+            stored.add(key)
+            stats['local'] += 1
+
+        def place(key, found):
+            """ Queue key's value for its k closest contacts in found. """
+            item = item_for(key)
+            candidates = {}
+            for contact in found + self._routingTable.findCloseNodes(key, constants.k):
+                if contact.id != self.id:
+                    candidates[contact.id] = contact
+            nodes = candidates.values()
+            nodes.sort(key=lambda contact: _distance(key, contact.id))
+            nodes = nodes[:constants.k]
 
-        df_list = defer.DeferredList(dfs)
-        return df_list
+            # The same rule as iterativeStore
+            if len(nodes) >= constants.k:
+                if _distance(key, self.id) < _distance(key, nodes[-1].id):
+                    nodes.pop()
+                    store_locally(item)
+            else:
+                store_locally(item)
+
+            for contact in nodes:
+                if contact.id not in batches:
+                    batches[contact.id] = (contact, [])
+                batches[contact.id][1].append(item)
+
+        def got_nodes(nodes, keys):
+            for key in keys:
+                place(key, list(nodes))
+
+        def lookup_failed(failure, keys):
+            logger.warn("Couldn't find nodes to store %d values on: %s",
+                    len(keys), failure.getErrorMessage())
+
+        def lookup(keys):
+            stats['lookups'] += 1
+            df = self.iterativeFindNode(keys[0])
+            df.addCallbacks(got_nodes, lookup_failed,
+                    callbackArgs=(keys,), errbackArgs=(keys,))
+            return df
+
+        def group_keys():
+            groups = {}
+            for key in marked:
+                contacts = self._routingTable.findCloseNodes(key, 1)
+                if contacts:
+                    group = contacts[0].id
+                else:
+                    group = None
+                groups.setdefault(group, []).append(key)
+            return groups.values()
+
+        def stored_items(val, items):
+            for item in items:
+                stored.add(item[0])
+
+        def send_all(contact, items):
+            """ Send contact every batch of items, one batch at a time. """
+            df = defer.Deferred()
+            batched = [items[i:i + self.storeBatchSize]
+                    for i in range(0, len(items), self.storeBatchSize)]
+
+            def send_next(val=None):
+                if not batched:
+                    df.callback(None)
+                    return
+                batch = batched.pop(0)
+                stats['rpcs'] += 1
+                rpc_df = contact.storeValues(batch)
+                rpc_df.addCallback(stored_items, batch)
+                rpc_df.addCallbacks(send_next, probe, errbackArgs=(batch,))
+
+            def probe(failure, batch):
+                # Contacts that predate storeValues only understand store.
+                logger.debug("storeValues to %r failed (%s); trying store",
+                        contact, failure.getErrorMessage())
+                rest = batch[1:] + [item for b in batched for item in b]
+                stats['rpcs'] += 1
+                probe_df = contact.store(*batch[0])
+                probe_df.addCallback(stored_items, batch[:1])
+                probe_df.addCallbacks(one_by_one, dead, callbackArgs=(rest,))
+
+            def one_by_one(val, rest):
+                dfs = []
+                for item in rest:
+                    stats['rpcs'] += 1
+                    item_df = contact.store(*item)
+                    item_df.addCallback(stored_items, [item])
+                    dfs.append(item_df)
+                list_df = defer.DeferredList(dfs, consumeErrors=True)
+                list_df.addCallback(df.callback)
+
+            def dead(failure):
+                logger.warn("Storing values on %r failed: %s",
+                        contact, failure.getErrorMessage())
+                stats['failed'] += 1
+                df.callback(None)
+
+            send_next()
+            return df
+
+        def send_batches(val):
+            dfs = []
+            for contact, items in batches.values():
+                stats['contacts'] += 1
+                dfs.append(sem.run(send_all, contact, items))
+            return defer.DeferredList(dfs)
+
+        def done(val):
+            # Anything that didn't make it anywhere waits for the next flush,
+            # unless it has been written again since.
+            for key in marked:
+                if key in stored or key in self.markedValues:
+                    continue
+                self.markedValues[key] = marked[key]
+                self.bytesPending += value_size(marked[key][0])
+                stats['kept'] += 1
+            if stats['kept'] and self._markedSince is None:
+                self._markedSince = markedSince or time.time()
+
+            now = time.time()
+            stats['elapsed'] = now - start
+            if markedSince is not None:
+                stats['lag'] = now - markedSince
+            else:
+                stats['lag'] = 0.0
+
+            self.timesFlushed += 1
+            self.flushStats = stats
+            logger.info("Flushed %d values to %d contacts in %d lookups and "
+                    "%d RPCs (%d failed; %d stored locally, %d kept) in %.2fs; "
+                    "lag %.2fs",
+                    stats['values'], stats['contacts'], stats['lookups'], stats['rpcs'],
+                    stats['failed'], stats['local'], stats['kept'],
+                    stats['elapsed'], stats['lag'])
+
+            self._flushing = None
+            waiters, self._flushWaiters = self._flushWaiters, []
+            if waiters:
+                next_df = self.flushWrites()
+                for waiter in waiters:
+                    next_df.addBoth(lambda result, w=waiter: w.callback(result) or result)
+            return stats
+
+        df = defer.DeferredList([sem.run(lookup, keys) for keys in group_keys()])
+        self._flushing = df
+        df.addCallback(send_batches)
+        df.addCallback(done)
+        return df
 
     def flushCache(self):
-        self.cachedValues = {}
+        self.cachedValues.clear()
 
@@ -170,6 +170,7 @@ class HTTPClient(twh.HTTPClient):
             # Send the self.__buffer file to marsyas for analysis!
             self.__buffer.close()
             self.__buffer = None
+            self.factory.received = True
             self.factory.callback(self.__buffer_name)
 
     def lineReceived(self, line):
@@ -213,7 +214,8 @@ class HTTPClientFactory(twc.HTTPClientFactory):
 
     def __init__(self, callback, key, url, method='GET', postdata=None,
                  headers=None, agent="Twisted PageGetter", timeout=0,
-                 cookies=None, followRedirect=1, redirectLimit=20):
+                 cookies=None, followRedirect=1, redirectLimit=20,
+                 errback=None):
         """Initialize the Client Factory (builder)
 
         Additional parameter "callback" is expected to be a function that takes
@@ -222,6 +224,10 @@ class HTTPClientFactory(twc.HTTPClientFactory):
         It will be called with the received file as an argument, if receipt of
         the file is successful.
 
+        Optional parameter "errback" is called with the reason if the
+        connection fails, or closes without the file having been received
+        (eg, the server refused the request).
+
         Additional parameter "key" is expected to be an ascii-encoded byte string
         that will uniquely identify the request.
         """
@@ -230,15 +236,26 @@ class HTTPClientFactory(twc.HTTPClientFactory):
                 agent, timeout, cookies, followRedirect, redirectLimit)
 
         self.callback = callback
+        self.errback = errback
         self.request_key = key
+        self.received = False
+        # Failures are reported through errback instead.
+        self.deferred.addErrback(lambda failure: None)
+
+    def _failed(self, reason):
+        if not self.received and self.errback is not None:
+            errback, self.errback = self.errback, None
+            errback(reason.getErrorMessage())
 
     def clientConnectionLost(self, connector, reason):
         logger.debug('Lost connection.  Reason: %r', reason)
         twc.HTTPClientFactory.clientConnectionLost(self, connector, reason)
+        self._failed(reason)
 
     def clientConnectionFailed(self, connector, reason):
         logger.debug('Connection failed. Reason: %r', reason)
         twc.HTTPClientFactory.clientConnectionFailed(self, connector, reason)
+        self._failed(reason)
 
 
 
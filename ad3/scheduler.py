@@ -0,0 +1,137 @@
+"""
+Scheduling of vector generation jobs.
+
+A GenerationScheduler owns a queue of audio files waiting to have their
+plugin vectors generated. Files are run through a generation function
+(see Controller.generate_vectors) at most C{max_concurrent} at a time.
+
+Ordering:
+    - files with a lower priority number run first
+    - among files of equal priority, users take turns, so that one user
+      adding a large library does not starve everybody else
+    - otherwise, first come first served
+"""
+import heapq
+import itertools
+from twisted.internet import defer
+
+from logs import logger
+
+
+class GenerationScheduler(object):
+    """
+    Attributes:
+        generate        function taking an AudioFile, returning a deferred
+        max_concurrent  number of files that may be generating at once
+        max_queued      queue depth at which callers of wait_for_room block
+        in_flight       number of files currently generating
+    """
+    def __init__(self, generate, max_concurrent=4, max_queued=100):
+        self.generate = generate
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+
+        self.in_flight = 0
+        self._queues = {}   # user_name -> heap of (priority, seq, audio_file, df)
+        self._turns = []    # user_names with queued files, in turn order
+        self._waiting = []  # deferreds waiting for room in the queue
+        self._seq = itertools.count()
+
+    def __repr__(self):
+        return "<GenerationScheduler(queued=%d, in_flight=%d, waiting=%d)>" % (
+                self.queue_depth(), self.in_flight, len(self._waiting))
+
+    def queue_depth(self):
+        return sum([len(q) for q in self._queues.values()])
+
+    def is_full(self):
+        return self.queue_depth() >= self.max_queued
+
+    def stats(self):
+        return dict(
+            queued = self.queue_depth(),
+            in_flight = self.in_flight,
+            waiting = len(self._waiting),
+            users = len(self._turns),
+        )
+
+    def wait_for_room(self):
+        """ Immediately returns a deferred that will fire once the queue is
+        below max_queued.
+
+        Whenever there is room, waiters are released in order, for as long as
+        the queue stays below max_queued; it is checked again after each
+        waiter's callbacks have run. A caller that submits a file from its
+        callback therefore takes the room it was promised before the next
+        waiter is released. One that submits later doesn't hold on to it, so
+        more waiters may be released than there is room for.
+        """
+        df = defer.Deferred()
+        if not self._waiting and not self.is_full():
+            df.callback(None)
+        else:
+            self._waiting.append(df)
+        return df
+
+    def submit(self, audio_file, priority=0, user_name=None):
+        """ Queue audio_file for generation.
+
+        Immediately returns a deferred that will return the result of
+        self.generate(audio_file).
+        """
+        if user_name is None:
+            user_name = getattr(audio_file, 'user_name', None)
+
+        df = defer.Deferred()
+        if user_name not in self._queues:
+            self._queues[user_name] = []
+            self._turns.append(user_name)
+        entry = (priority, self._seq.next(), audio_file, df)
+        heapq.heappush(self._queues[user_name], entry)
+
+        logger.debug("Scheduled %r; %r", audio_file, self)
+        self._dispatch()
+        return df
+
+    def _pop(self):
+        # Pick the best priority at the head of any user's queue. Ties go to
+        # whichever user comes first in turn order.
+        best = None
+        for user_name in self._turns:
+            head = self._queues[user_name][0]
+            if best is None or head[0] < best[1][0]:
+                best = (user_name, head)
+
+        user_name = best[0]
+        entry = heapq.heappop(self._queues[user_name])
+
+        # This user goes to the back of the line.
+        self._turns.remove(user_name)
+        if self._queues[user_name]:
+            self._turns.append(user_name)
+        else:
+            del self._queues[user_name]
+
+        return entry
+
+    def _dispatch(self):
+        while self._turns and self.in_flight < self.max_concurrent:
+            priority, seq, audio_file, df = self._pop()
+            self.in_flight += 1
+
+            logger.debug("Begin generating vectors for %r", audio_file)
+            g_df = defer.maybeDeferred(self.generate, audio_file)
+            g_df.addBoth(self._finished, audio_file)
+            g_df.chainDeferred(df)
+
+        self._release_waiters()
+
+    def _finished(self, result, audio_file):
+        logger.debug("Finished generating vectors for %r", audio_file)
+        self.in_flight -= 1
+        self._dispatch()
+        return result
+
+    def _release_waiters(self):
+        while self._waiting and not self.is_full():
+            self._waiting.pop(0).callback(None)
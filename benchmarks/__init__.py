@@ -0,0 +1,8 @@
+"""
+Reproducible performance benchmarks for 3ad.
+
+    corpus  - generates synthetic WAV files to analyse
+    suite   - the benchmarks themselves, plus result comparison
+
+See scripts/benchmark.py to run them.
+"""
@@ -0,0 +1,68 @@
+"""
+Synthetic audio corpora.
+
+Every file is a mix of a few random sine tones and some noise, written as a
+16 bit mono WAV file. The same seed always produces the same corpus.
+"""
+import os
+import wave
+import random
+from numpy import arange, clip, int16, pi, sin, zeros
+from numpy.random import RandomState
+
+def make_tone(duration, rate, rng):
+    """
+    Returns an array of samples in the range [-1, 1], holding duration
+    seconds of audio at the provided sample rate.
+    """
+    t = arange(int(duration * rate)) / float(rate)
+    samples = zeros(len(t))
+
+    for i in range(rng.randint(1, 4)):
+        freq = rng.uniform(55, 4000)
+        amp = rng.uniform(0.1, 0.3)
+        samples += amp * sin(2 * pi * freq * t)
+
+    samples += rng.normal(0, rng.uniform(0.001, 0.05), len(t))
+    return clip(samples, -1, 1)
+
+def write_wav(file_name, samples, rate):
+    w = wave.open(file_name, 'wb')
+    try:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(rate)
+        w.writeframes((samples * 32767).astype(int16).tostring())
+    finally:
+        w.close()
+
+def make_corpus(directory, num_files=10, duration=30.0, rate=22050, seed=0):
+    """
+    Writes num_files synthetic WAV files of duration seconds each into
+    directory, creating it if need be.
+
+    Returns a list of the file names. Existing files with the same names are
+    reused, so that repeated runs don't pay for regeneration.
+    """
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    rng = RandomState(seed)
+    file_names = []
+    for i in range(num_files):
+        file_name = os.path.join(directory,
+                'synthetic_%d_%04d_%gs.wav' % (seed, i, duration))
+        file_names.append(os.path.abspath(file_name))
+
+        # Generate the samples even if the file exists, so that the random
+        # state, and with it every later file, stays the same.
+        samples = make_tone(duration, rate, rng)
+        if not os.path.exists(file_name):
+            write_wav(file_name, samples, rate)
+
+    return file_names
+
+def random_vectors(num, dimensions, seed=0):
+    """ Returns num random vectors (lists of floats) of the given length. """
+    rng = random.Random(seed)
+    return [[rng.uniform(0, 100) for d in range(dimensions)] for n in range(num)]
@@ -0,0 +1,260 @@
+"""
+The benchmarks.
+
+Every benchmark adds entries to a results dict of the form
+
+    name => {'runs': [seconds, ...], 'min': s, 'mean': s, 'max': s, 'items': n}
+
+or, if it couldn't run (eg, Marsyas isn't installed),
+
+    name => {'error': message}
+
+so that a whole run can be dumped to JSON, and compared against a baseline
+with compare().
+"""
+import sys
+import time
+import platform
+import traceback
+from twisted.internet import defer
+from twisted.internet import reactor
+
+import corpus
+from ad3.extraction import import_module
+
+def summarize(runs, items=1):
+    return {
+        'runs': runs,
+        'min': min(runs),
+        'mean': sum(runs) / len(runs),
+        'max': max(runs),
+        'items': items,
+    }
+
+def measure(results, name, fn, repeat=3, items=1):
+    """
+    Calls fn() repeat times and stores the timings in results[name].
+    Returns the value of the last call, or None if fn raised.
+    """
+    runs = []
+    value = None
+    try:
+        for i in range(repeat):
+            start = time.time()
+            value = fn()
+            runs.append(time.time() - start)
+    except Exception:
+        results[name] = {'error': traceback.format_exc()}
+        return None
+
+    results[name] = summarize(runs, items)
+    return value
+
+def metadata(**kwargs):
+    meta = {
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+    }
+    meta.update(kwargs)
+    return meta
+
+
+# Plugins
+
+def bench_plugins(results, file_names, module_names, repeat=1):
+    """ Times module.createVector over every file, for every plugin module. """
+    for module_name in module_names:
+        name = 'plugin.%s.createVector' % module_name.split('.')[-1]
+        try:
+            mod = import_module(module_name)
+        except Exception, e:
+            results[name] = {'error': 'import failed: %s' % e}
+            continue
+
+        def run():
+            for file_name in file_names:
+                mod.createVector(file_name)
+
+        measure(results, name, run, repeat, items=len(file_names))
+
+
+# Learners
+
+class _Obj(object):
+    """ Stands in for an AudioFile or Tag; learners only need these. """
+    def __init__(self, key, vector):
+        self.key = key
+        self.vector = vector
+
+    def get_key(self):
+        return self.key
+
+def bench_learners(results, num_files=1000, num_tags=50, dimensions=64, repeat=3):
+    from ad3.learning.euclid import Euclidean
+
+    files = [_Obj('f%d' % i, v) for i, v in
+            enumerate(corpus.random_vectors(num_files, dimensions, seed=1))]
+    tags = [_Obj('t%d' % i, v) for i, v in
+            enumerate(corpus.random_vectors(num_tags, dimensions, seed=2))]
+    pairs = num_files * num_tags
+
+    euclid = Euclidean(None, tolerable_distance=200)
+
+    def does_tag_match():
+        for f in files:
+            for t in tags:
+                euclid.does_tag_match(f, t)
+
+    measure(results, 'learner.euclid.does_tag_match', does_tag_match, repeat, items=pairs)
+    measure(results, 'learner.euclid.match_matrix',
+            lambda: euclid.match_matrix(files, tags), repeat, items=pairs)
+
+    try:
+        from ad3.learning import gauss
+    except Exception, e:
+        results['learner.gauss.train'] = {'error': 'import failed: %s' % e}
+        results['learner.gauss.predict'] = {'error': 'import failed: %s' % e}
+        return
+
+    data = [f.vector for f in files]
+    classifier = measure(results, 'learner.gauss.train',
+            lambda: gauss.train(data), repeat, items=num_files)
+    if classifier is not None:
+        measure(results, 'learner.gauss.predict',
+                lambda: gauss.predict(data, classifier), repeat, items=num_files)
+
+
+# End to end
+
+def bench_add_files(results, file_names, num_nodes=3, base_port=45000,
+        tags=None, join_wait=2.0, timeout=600):
+    """
+    Starts num_nodes Nodes on loopback, then times Controller.add_files for
+    every file, followed by flushing the node's buffered writes.
+
+    Must be called with the reactor running. Immediately returns a deferred
+    that will return once the measurements, or an error, have been stored in
+    results, and the nodes have been shut down. If the run takes longer than
+    timeout seconds, it is recorded as an error, and the nodes are shut down
+    without waiting for it.
+    """
+    outer_df = defer.Deferred()
+    nodes = []
+
+    def finish(val):
+        if timer.active():
+            timer.cancel()
+        if outer_df.called:
+            return
+        df = _stop_nodes(nodes)
+        df.addBoth(lambda v: outer_df.callback(None))
+
+    def failed(failure):
+        if 'add_files' not in results:
+            results['add_files'] = {'error': failure.getTraceback()}
+
+    def timed_out():
+        results['add_files'] = {'error': 'timed out after %ds' % timeout}
+        df = _stop_nodes(nodes)
+        df.addBoth(lambda v: outer_df.callback(None))
+
+    timer = reactor.callLater(timeout, timed_out)
+    df = defer.maybeDeferred(_run_add_files, results, file_names,
+            num_nodes, base_port, tags, join_wait, nodes)
+    df.addErrback(failed)
+    df.addBoth(finish)
+    return outer_df
+
+def _stop_nodes(nodes):
+    """ Shut down every node in nodes, emptying the list. Returns a deferred
+    that will return once their ports are closed.
+    """
+    dfs = []
+    while nodes:
+        dfs.append(defer.maybeDeferred(nodes.pop().leaveNetwork))
+    return defer.DeferredList(dfs, consumeErrors=True)
+
+def _run_add_files(results, file_names, num_nodes, base_port, tags, join_wait, nodes):
+    """ Start the nodes, appending each to nodes as soon as it exists, so
+    that the caller can always shut them down; then run the measurements.
+    """
+    import ad3.models.dht
+    from entangled.kademlia.datastore import DictDataStore
+    from ad3.controller import Controller
+    from ad3.learning.euclid import Euclidean
+
+    model = ad3.models.dht
+    for i in range(num_nodes):
+        port = base_port + i
+        node = model.Node(udpPort=port, tcpPort=port, dataStore=DictDataStore())
+        nodes.append(node)
+        if i == 0:
+            node.joinNetwork([])
+        else:
+            node.joinNetwork([('127.0.0.1', base_port)])
+
+    first = nodes[0]
+    model.set_network_handler(model.NetworkHandler(first))
+    controller = Controller(model, Euclidean(model))
+    for node in nodes:
+        node.generate_all_plugin_vectors = controller.generate_all_plugin_vectors
+
+    timings = {}
+
+    def add(val):
+        timings['start'] = time.time()
+        df = controller.add_files(file_names, 'benchmark', tags)
+        return df
+
+    def flush(val):
+        timings['added'] = time.time()
+        df = first.flushWrites()
+        return df
+
+    def done(val):
+        timings['flushed'] = time.time()
+        results['add_files'] = summarize(
+                [timings['added'] - timings['start']], len(file_names))
+        results['add_files.flush'] = summarize(
+                [timings['flushed'] - timings['added']], len(file_names))
+        results['add_files.nodes'] = {'items': num_nodes}
+        return val
+
+    def failed(failure):
+        results['add_files'] = {'error': failure.getTraceback()}
+        return None
+
+    # Give the nodes a chance to find each other.
+    df = defer.Deferred()
+    df.addCallback(add)
+    df.addCallback(flush)
+    df.addCallbacks(done, failed)
+    reactor.callLater(join_wait, df.callback, None)
+    return df
+
+
+# Comparison
+
+def compare(results, baseline, tolerance=0.1):
+    """
+    Compares the mean time of each benchmark in results against baseline.
+
+    Returns a list of (name, baseline mean, current mean, ratio, regressed)
+    tuples, sorted by name, for every benchmark that ran in both. A
+    benchmark has regressed if it is more than tolerance (a fraction)
+    slower than the baseline.
+    """
+    rows = []
+    for name in sorted(results):
+        current = results[name]
+        previous = baseline.get(name)
+        if previous is None or 'mean' not in current or 'mean' not in previous:
+            continue
+        if previous['mean'] > 0:
+            ratio = current['mean'] / previous['mean']
+        else:
+            ratio = 1.0
+        rows.append((name, previous['mean'], current['mean'], ratio,
+                ratio > 1 + tolerance))
+    return rows
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+def usage():
+    print("Usage: python benchmark.py [-o or --output=results.json] [-b or --baseline=baseline.json]")
+    print("           [-n or --files=10] [-d or --duration=30] [-c or --corpus=directory]")
+    print("           [-r or --repeat=3] [-t or --tolerance=0.1] [--nodes=3] [--port=45000]")
+    print("           [--timeout=600]")
+    print("           [--no-plugins] [--no-learners] [--no-network]")
+
+
+if __name__ == "__main__":
+    import sys
+    import os
+    import getopt
+    import tempfile
+    import simplejson
+
+    # ensure the main ad3 module is on the path
+    parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    if parent_dir not in sys.path:
+        sys.path.append(parent_dir)
+
+    from twisted.internet import defer
+    from twisted.internet import reactor
+    from benchmarks import corpus, suite
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "o:b:n:d:c:r:t:", [
+            "output=", "baseline=", "files=", "duration=", "corpus=",
+            "repeat=", "tolerance=", "nodes=", "port=", "timeout=",
+            "no-plugins", "no-learners", "no-network"])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    options = {
+        'output': None,
+        'baseline': None,
+        'files': 10,
+        'duration': 30.0,
+        'corpus': os.path.join(tempfile.gettempdir(), '3ad_benchmark_corpus'),
+        'repeat': 3,
+        'tolerance': 0.1,
+        'nodes': 3,
+        'port': 45000,
+        'timeout': 600,
+        'plugins': True,
+        'learners': True,
+        'network': True,
+    }
+    for opt, val in opts:
+        if opt in ("-o", "--output"):
+            options['output'] = val
+        elif opt in ("-b", "--baseline"):
+            options['baseline'] = val
+        elif opt in ("-n", "--files"):
+            options['files'] = int(val)
+        elif opt in ("-d", "--duration"):
+            options['duration'] = float(val)
+        elif opt in ("-c", "--corpus"):
+            options['corpus'] = val
+        elif opt in ("-r", "--repeat"):
+            options['repeat'] = int(val)
+        elif opt in ("-t", "--tolerance"):
+            options['tolerance'] = float(val)
+        elif opt == "--nodes":
+            options['nodes'] = int(val)
+        elif opt == "--port":
+            options['port'] = int(val)
+        elif opt == "--timeout":
+            options['timeout'] = float(val)
+        elif opt.startswith("--no-"):
+            options[opt[5:]] = False
+
+    file_names = corpus.make_corpus(options['corpus'],
+            options['files'], options['duration'])
+
+    results = {}
+    if options['plugins']:
+        suite.bench_plugins(results, file_names, [
+            'ad3.analysis_plugins.bextract_plugin',
+            'ad3.analysis_plugins.charlotte',
+            'ad3.analysis_plugins.centroid_plugin',
+        ])
+    if options['learners']:
+        suite.bench_learners(results, repeat=options['repeat'])
+
+    if options['network']:
+        def network_failed(failure):
+            results['add_files'] = {'error': failure.getTraceback()}
+
+        def run_network():
+            df = defer.maybeDeferred(suite.bench_add_files, results, file_names,
+                    options['nodes'], options['port'], timeout=options['timeout'])
+            df.addErrback(network_failed)
+            df.addBoth(lambda v: reactor.stop())
+        reactor.callWhenRunning(run_network)
+        reactor.run()
+
+    report = {
+        'meta': suite.metadata(**dict([(k, options[k]) for k in
+            ('files', 'duration', 'repeat', 'nodes')])),
+        'benchmarks': results,
+    }
+
+    if options['output']:
+        f = open(options['output'], 'w')
+        simplejson.dump(report, f, indent=2, sort_keys=True)
+        f.close()
+    else:
+        print(simplejson.dumps(report, indent=2, sort_keys=True))
+
+    regressions = 0
+    if options['baseline']:
+        f = open(options['baseline'])
+        baseline = simplejson.load(f)['benchmarks']
+        f.close()
+
+        print("%-45s %12s %12s %8s" % ("benchmark", "baseline", "current", "ratio"))
+        for name, before, after, ratio, regressed in \
+                suite.compare(results, baseline, options['tolerance']):
+            flag = regressed and "  REGRESSED" or ""
+            print("%-45s %12.4f %12.4f %8.2f%s" % (name, before, after, ratio, flag))
+            if regressed:
+                regressions += 1
+
+    sys.exit(regressions and 1 or 0)
@@ -39,6 +39,7 @@ from ad3.learning.euclid import Euclidean
 from ad3.learning.gauss import Gaussian
 from ad3.learning.svm import SVM
 from ad3.controller import Controller, TagAggregator, FileAggregator
+from ad3.extraction import ProcessPoolExecutor
 
 import logging
 from entangled.kademlia import logs as kademlia_logs
@@ -180,12 +181,17 @@ def sync(fn):
     s.__doc__ = fn.__doc__
     return s
 
-def connect(udpPort=None, tcpPort=None, userName=None, knownNodes=None, dbFile=':memory:', logFile='3ad.log'):
+def connect(udpPort=None, tcpPort=None, userName=None, knownNodes=None, dbFile=':memory:', logFile='3ad.log',
+        workers=None, maxTasksPerWorker=None, extractTimeout=None, cacheBytes=32*1024*1024):
     """
     udpPort: int
     userName: str
     knownNodes: list of tuples in form [('127.0.0.1', 4000)]
     dbFile: path to sqlite database file
+    workers: number of extraction processes; 0 runs plugins in a thread
+    maxTasksPerWorker: recycle an extraction process after this many files
+    extractTimeout: seconds a single file's extraction may take (default 300; 0: no limit)
+    cacheBytes: memory the node may use to cache DHT values
 
     udpPort will be read from first command line argument, if None
     userName will be read from second command line argument, if None
@@ -203,7 +209,8 @@ def connect(udpPort=None, tcpPort=None, userName=None, knownNodes=None, dbFile='
     # Set up model with its network node
     model = ad3.models.dht
     dataStore = SQLiteDataStore(dbFile=dbFile)
-    node = ad3.models.dht.Node(udpPort=udpPort, tcpPort=tcpPort, dataStore=dataStore)
+    node = ad3.models.dht.Node(udpPort=udpPort, tcpPort=tcpPort, dataStore=dataStore,
+            cacheBytes=cacheBytes)
 #    node = entangled.dtuple.DistributedTupleSpacePeer(udpPort=udpPort, dataStore=dataStore)
 #    node = entangled.node.EntangledNode(udpPort=udpPort, dataStore=dataStore)
 #    node = entangled.kademlia.node.Node(udpPort=udpPort, dataStore=dataStore)
@@ -238,8 +245,18 @@ def connect(udpPort=None, tcpPort=None, userName=None, knownNodes=None, dbFile='
     # Set up the classifier
     gaussian = Gaussian(model, 100)
 
+    # Set up the plugin extraction workers
+    if workers == 0:
+        executor = None
+    else:
+        module_names = [plugin.module_name for plugin in ad3.models.dht.dht.plugins]
+        executor = ProcessPoolExecutor(module_names, workers=workers,
+                max_tasks_per_worker=maxTasksPerWorker, timeout=extractTimeout)
+        # Take on as many offloaded computations as we have workers for.
+        node.offloadSlots = executor.workers
+
     # Set up the controller
-    controller = Controller(model, gaussian)
+    controller = Controller(model, gaussian, executor)
 
     # FIXME: this should not be applied after the node is initialized, but i'm way too lazy right now to do it cleanly.
     node.generate_all_plugin_vectors = controller.generate_all_plugin_vectors
@@ -252,17 +269,91 @@ def connect(udpPort=None, tcpPort=None, userName=None, knownNodes=None, dbFile='
 
 @cont
 def clear_network_cache():
-    ad3.models.dht.dht._network_handler._cache = {}
+    ad3.models.dht.dht._network_handler.cache.clear()
+    ad3.models.dht.dht._network_handler.index.forget()
     return None
 
 @cont
 def print_network_cache():
     n = p.terminalProtocol.namespace
-    cache = n['controller'].model.get_network_handler()._cache
+    cache = n['controller'].model.get_network_handler().cache
+
+    print "\r"
+    for key, obj in sorted(cache.items()):
+        print "%s => %r\r\n\r" % (key.encode('hex'), obj)
+    return None
+
+@cont
+def print_network_cache_stats():
+    n = p.terminalProtocol.namespace
+    stats = n['controller'].model.get_network_handler().cache.stats()
+
+    print "\r"
+    for x in sorted(stats.keys()):
+        print "%s => %r\r" % (x, stats[x])
+    return None
+
+@cont
+def print_tuple_index_stats():
+    n = p.terminalProtocol.namespace
+    stats = n['controller'].model.get_network_handler().index.stats()
+
+    print "\r"
+    for x in sorted(stats.keys()):
+        print "%s => %r\r" % (x, stats[x])
+    return None
+
+@cont
+def print_value_cache_stats():
+    n = p.terminalProtocol.namespace
+    node = n['node']
+
+    print "\r"
+    print "entries => %r\r" % len(node.cachedValues)
+    print "bytes => %r\r" % node.cachedValues.bytes
+    print "max_bytes => %r\r" % node.cachedValues.max_bytes
+    print "evictions => %r\r" % node.cachedValues.evictions
+    print "timesCacheFetched => %r\r" % node.timesCacheFetched
+    print "bytesCacheFetched => %r\r" % node.bytesCacheFetched
+    print "timesMarked => %r\r" % node.timesMarked
+    print "bytesMarked => %r\r" % node.bytesMarked
+    return None
+
+@cont
+def print_flush_stats():
+    n = p.terminalProtocol.namespace
+    node = n['node']
+
+    print "\r"
+    print "pending_values => %r\r" % len(node.markedValues)
+    print "pending_bytes => %r\r" % node.bytesPending
+    print "flushes => %r\r" % node.timesFlushed
+    for x in sorted(node.flushStats.keys()):
+        print "last_%s => %r\r" % (x, node.flushStats[x])
+    return None
+
+@cont
+def print_generation_queue():
+    n = p.terminalProtocol.namespace
+    stats = n['controller'].scheduler.stats()
 
     print "\r"
-    for x in sorted(cache.keys()):
-        print "%s => %r\r\n\r" % (x.encode('hex'), cache[x])
+    for x in sorted(stats.keys()):
+        print "%s => %r\r" % (x, stats[x])
+    return None
+
+@cont
+def print_tag_refresh():
+    n = p.terminalProtocol.namespace
+    job = n['controller'].tag_refresh
+    if job is None:
+        print "No tag refresh has been started\r"
+        return None
+
+    stats = job.progress()
+    print "\r"
+    for x in sorted(stats.keys()):
+        print "%s => %r\r" % (x, stats[x])
     return None
 
 @cont
@@ -526,12 +617,14 @@ def print_files(files):
 
 @sync
 @cont
-def update_tag_vectors():
+def update_tag_vectors(full=False):
     """
     Update the vectors for all tags based on the vectors for all files with each tag.
+
+    full: rebuild each tag's running statistics from scratch
     """
     n = p.terminalProtocol.namespace
-    df = n['controller'].update_tag_vectors()
+    df = n['controller'].update_tag_vectors(full=full)
     return df
 
 @sync
@@ -731,13 +824,21 @@ def add_cal500_files(num=0, tag_em=True, min_examples=5):
 
 @sync
 @cont
-def remove_untagged_files():
+def remove_untagged_files(limit=16):
+    """
+    Remove every one of this user's files that has no tags, checking at
+    most limit files at a time. Prints the number of files and tuples
+    removed.
+    """
     n = p.terminalProtocol.namespace
     node = n['controller'].model.get_network_handler().node
+    sem = defer.DeferredSemaphore(limit)
+    removed = {'files': 0, 'tuples': 0}
 
     def got_tags(tags, file):
         ad3_logs.logger.debug("Got Tags (%d): %r for %r", len(tags), tags, file)
         if len(tags) == 0:
+            removed['files'] += 1
             df_t = remove_file_tuples(file)
             df_f = remove_file(file)
             df_list = defer.DeferredList([df_t, df_f])
@@ -745,27 +846,38 @@ def remove_untagged_files():
         else:
             return None
 
+    def counted_tuples(count):
+        removed['tuples'] += count
+        return count
+
     def remove_file_tuples(file):
         file_tuple = ("audio_file", file.key, file.file_name, file.user_name)
         df = n['controller'].model._network_handler.dht_remove_tuples(file_tuple)
+        df.addCallback(counted_tuples)
         return df
 
     def remove_file(file):
         df = node.iterativeDelete(file.key)
         return df
 
+    def check_file(file):
+        df = n['controller'].model.get_tags(audio_file=file)
+        df.addCallback(got_tags, file)
+        return df
+
     def got_files(files):
         ad3_logs.logger.debug("Got Files (%d): %r", len(files), files)
-        dfs = []
-        for file in files:
-            df = n['controller'].model.get_tags(audio_file=file)
-            df.addCallback(got_tags, file)
-            dfs.append(df)
+        dfs = [sem.run(check_file, file) for file in files]
         df_list = defer.DeferredList(dfs)
         return df_list
 
+    def done(val):
+        print "Removed %(files)d untagged files (%(tuples)d tuples)\r" % removed
+        return removed
+
     df = n['controller'].model.get_audio_files(user_name=n['userName'])
-    df.addBoth(got_files)
+    df.addCallback(got_files)
+    df.addCallback(done)
 
     return df
 
@@ -841,7 +953,13 @@ cmds = dict(
     add_tags=add_tags,
     clear_network_cache=clear_network_cache,
     print_network_cache=print_network_cache,
+    print_network_cache_stats=print_network_cache_stats,
+    print_value_cache_stats=print_value_cache_stats,
+    print_tuple_index_stats=print_tuple_index_stats,
+    print_flush_stats=print_flush_stats,
     print_data_store=print_data_store,
+    print_generation_queue=print_generation_queue,
+    print_tag_refresh=print_tag_refresh,
     sync = sync,
     add_file=add_file,
     add_files=add_files,
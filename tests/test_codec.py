@@ -0,0 +1,56 @@
+import os
+import sys
+import zlib
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ad3.models.dht import codec
+
+KEY = 'k' * codec.KEY_LENGTH
+CLASSIFIER = zlib.compress('GaussianClassifier/cl').encode('base64')
+
+
+class VectorShapeTest(unittest.TestCase):
+    """ Each learner's file and tag vectors survive a round trip. """
+
+    def round_trip(self, record_type, **fields):
+        record = dict(type=record_type, key=KEY, **fields)
+        return codec.decode(codec.encode(record))
+
+    def test_euclidean_audio_file(self):
+        record = self.round_trip('audio_file', file_name=u'a.mp3',
+                user_name=u'me', vector=[1.5, -2.0, 0.0])
+        self.assertEqual(record['vector'], [1.5, -2.0, 0.0])
+
+    def test_euclidean_tag(self):
+        record = self.round_trip('tag', name=u'rock', count=2,
+                vector=[0.5, 1.0], vector_sum=[1.0, 2.0])
+        self.assertEqual(record['vector'], [0.5, 1.0])
+        self.assertEqual(record['vector_sum'], [1.0, 2.0])
+        self.assertEqual(record['count'], 2)
+
+    def test_gaussian_audio_file(self):
+        for vector in ([[1.5, 2.5], None], [[1.5, 2.5], [True, False]]):
+            record = self.round_trip('audio_file', file_name=u'a.mp3',
+                    user_name=u'me', vector=vector)
+            self.assertEqual(record['vector'], vector)
+
+    def test_gaussian_tag(self):
+        for vector in ([CLASSIFIER, None], [CLASSIFIER, CLASSIFIER]):
+            record = self.round_trip('tag', name=u'rock', vector=vector)
+            self.assertEqual(record['vector'], vector)
+            self.assertEqual(zlib.decompress(record['vector'][0].decode('base64')),
+                    'GaussianClassifier/cl')
+
+    def test_numeric_strings_are_not_parsed(self):
+        record = self.round_trip('tag', name=u'rock', vector=['1.5', '2'])
+        self.assertEqual(record['vector'], ['1.5', '2'])
+
+    def test_none_vector(self):
+        record = self.round_trip('tag', name=u'rock', vector=None)
+        self.assertEqual(record['vector'], None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from twisted.internet import defer
+
+from ad3 import extraction
+from ad3.controller import Controller
+from ad3.models.dht import AudioFile, Plugin
+
+
+class FailingExecutor(object):
+    def generate_vectors(self, plugins, file_name, file_key):
+        return defer.fail(extraction.ExtractionTimeout(file_name))
+
+    def shutdown(self):
+        pass
+
+
+class Model(object):
+    def get_plugins(self):
+        return defer.succeed([Plugin('p', 'mod', key='p' * 20)])
+
+    def get_plugin_vectors_by_digest(self, plugins, digest):
+        return defer.succeed({})
+
+    def special_generate_plugin_vectors(self, audio_file):
+        return defer.succeed(None)
+
+
+class GenerationFailureTest(unittest.TestCase):
+    """ A file whose generation fails gives up its slot. """
+
+    def test_failure_releases_slot(self):
+        controller = Controller(Model(), None, executor=FailingExecutor(),
+                generating_limit=2)
+        failures = []
+        for i in range(3):
+            audio_file = AudioFile('%d.mp3' % i, user_name='me',
+                    key=str(i) * 20, content_digest='d%d' % i)
+            df = controller.get_vectors_eventually(audio_file)
+            df.addErrback(failures.append)
+
+        self.assertEqual(len(failures), 3)
+        for failure in failures:
+            failure.trap(extraction.ExtractionTimeout)
+        self.assertEqual(controller.scheduler.stats()['in_flight'], 0)
+        self.assertEqual(controller.scheduler.stats()['queued'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()